@@ -0,0 +1,131 @@
+"""
+asyncio variant of the Pinhole proxy.
+
+usage 'async_pipe [--stream] [--zero-copy] [--raw] [--recv-size=bytes] [--high-water=bytes] [--low-water=bytes]
+                  [--backlog=n] port host [newport]'
+
+Takes the same arguments as pinhole.py, but serves all connections from one
+event loop: each direction of a connection is a task instead of an OS
+thread, so idle keep-alive connections cost little more than their buffers.
+"""
+
+import asyncio
+import sys
+
+import http_parser
+from command_line import parse_command_line, setup_outputs
+from communication import Communication
+from pipe import BACKLOG, HEADERS_TOO_LARGE, Pipe, PipeThread, log
+
+
+class AsyncPipe(Pipe):
+    pipes = []
+
+    def __init__(self, reader, writer, tag, communication, newhost, newport, **options):
+        Pipe.__init__(self, tag, communication, newhost, newport, **options)
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, data):
+        self.writer.write(data)
+
+    def send_buffers(self, buffers):
+        self.writer.writelines(buffers)
+
+    def send_backlog(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    async def run(self):
+        AsyncPipe.pipes.append(self)
+        log('%s pipes active' % len(AsyncPipe.pipes))
+        self.create_parser()
+        # drain() waits from when the data waiting to be written pass the high mark until they fall below the low one
+        self.writer.transport.set_write_buffer_limits(self.flow.high_water, self.flow.low_water)
+        try:
+            while 1:
+                try:
+                    data = await self.reader.read(self.recv_size)
+                except ConnectionResetError:
+                    data = b""
+
+                self.feed(data)
+                await self.writer.drain()
+                self.flow.update(self.held())
+
+                if not data:
+                    break
+        except http_parser.LimitExceeded as ex:
+            log('%s %s' % (self, ex))
+            if self.tag == 'request':
+                self.reject_request()
+        except Exception as ex:
+            print(ex)
+        finally:
+            AsyncPipe.pipes.remove(self)
+            # Also counts the parser stats of the pipe in the totals
+            PipeThread.pipe_finished(self)
+            log('%s pipes active' % len(AsyncPipe.pipes))
+            if self.reject_pending:
+                if self.between_messages():
+                    self.writer.write(HEADERS_TOO_LARGE)
+                self.writer.close()
+            elif self.writer.can_write_eof() and not self.writer.is_closing():
+                self.writer.write_eof()
+
+    def reject_request(self):
+        """Have the client told its request is too large, by the response pipe, which writes to the client"""
+        if self.response_pipe is not None and self.response_pipe in AsyncPipe.pipes:
+            self.response_pipe.reject_pending = True
+        # Ends the reads of the response pipe
+        self.writer.close()
+
+
+class AsyncPinhole:
+    def __init__(self, port, newhost, newport, communication_class=Communication, backlog=BACKLOG, **pipe_options):
+        log('Redirecting: localhost:%s -> %s:%s' % (port, newhost, newport))
+        self.port = port
+        self.newhost = newhost
+        self.newport = newport
+        self.communication_class = communication_class
+        self.backlog = backlog
+        self.pipe_options = pipe_options
+
+    async def handle_connection(self, client_reader, client_writer):
+        log('Creating new session for %s' % (client_writer.get_extra_info('peername'),))
+        try:
+            server_reader, server_writer = await asyncio.open_connection(self.newhost, self.newport)
+        except OSError as ex:
+            print(ex)
+            client_writer.close()
+            return
+
+        comm = self.communication_class()
+        request = AsyncPipe(client_reader, server_writer, 'request', comm, self.newhost, self.newport,
+                            **self.pipe_options)
+        request.response_pipe = AsyncPipe(server_reader, client_writer, 'response', comm, self.newhost, self.newport,
+                                          **self.pipe_options)
+        try:
+            await asyncio.gather(request.run(), request.response_pipe.run())
+        finally:
+            server_writer.close()
+            client_writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection, '', self.port, backlog=self.backlog)
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+
+if __name__ == '__main__':
+    print('Starting Pinhole (asyncio)')
+
+    port, newhost, newport, options = parse_command_line(sys.argv)
+    if options.pop('pool', False):
+        print('--pool is not supported by the asyncio Pinhole, ignoring it')
+    if options.pop('workers', None) is not None:
+        print('--workers is not supported by the asyncio Pinhole, ignoring it')
+    setup_outputs(options)
+    AsyncPinhole(port, newhost, newport, **options).run()
@@ -0,0 +1,225 @@
+"""
+Microbenchmarks for the parsers.
+
+usage 'python benchmarks.py [name ...]'
+
+Runs all benchmarks, or only the named ones, and prints the timings.
+"""
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+
+import chunking_parser
+import delimiting_parser
+import flat_http_parser
+import http_parser
+import offline
+import parser_utils
+from parser_utils import SPACES, feed, get_more, intialize_parser, parse
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def report(name, seconds, count, unit="ops"):
+    print("%-40s %10.1f %s/s" % (name, count / seconds, unit))
+
+
+def get_word_per_byte(data):
+    """The original get_word, walking the buffer one item at a time, kept for comparison"""
+    while not data:
+        data = yield from get_more(data)
+
+    lindex = 0
+    while data[lindex] not in SPACES:
+        lindex += 1
+        while len(data) <= lindex:
+            data = yield from get_more(data)
+
+    rindex = lindex
+    while data[rindex] in SPACES:
+        rindex += 1
+        while len(data) <= rindex:
+            data = yield from get_more(data)
+
+    word = data.take(lindex)
+    data.skip(rindex - lindex)
+    return word, data
+
+
+def get_request_line_with(get_word):
+    def get_request_line(data):
+        method, data = yield from get_word(data)
+        path, data = yield from get_word(data)
+        version, data = yield from get_word(data)
+        return (method, path, version), data
+
+    return get_request_line
+
+
+@benchmark
+def bench_get_word():
+    line = b"GET /some/rather/long/path/to/a/resource?with=query&string=1 HTTP/1.1\r\n"
+    lines = line * 1000
+    for name, get_word in (("per-byte loop", get_word_per_byte), ("regex scan", parser_utils.get_word)):
+        parser = intialize_parser(get_request_line_with(get_word))
+        seconds = min(timeit.repeat(lambda: list(parse(parser, lines)), number=1, repeat=5))
+        report("get_word, %s" % name, seconds, 1000, "lines")
+
+
+RESPONSE = b"HTTP/1.1 200 OK\r\n" + \
+           b"Date: Sun, 18 Oct 2026 10:00:00 GMT\r\n" + \
+           b"Server: Apache/2.4.41 (Ubuntu)\r\n" + \
+           b"Last-Modified: Sat, 17 Oct 2026 09:00:00 GMT\r\n" + \
+           b"ETag: \"2aa6-5b4c3a8e1f2c0\"\r\n" + \
+           b"Accept-Ranges: bytes\r\n" + \
+           b"Vary: Accept-Encoding\r\n" + \
+           b"Cache-Control: max-age=3600\r\n" + \
+           b"Expires: Sun, 18 Oct 2026 11:00:00 GMT\r\n" + \
+           b"X-Frame-Options: SAMEORIGIN\r\n" + \
+           b"X-Content-Type-Options: nosniff\r\n" + \
+           b"Content-Type: text/html; charset=UTF-8\r\n" + \
+           b"Content-Length: 16\r\n" + \
+           b"\r\n" + \
+           b"<html>hi</html>\n"
+
+
+@benchmark
+def bench_http_messages():
+    messages = RESPONSE * 1000
+    for name, get_http_request in (("combinators", http_parser.get_http_request),
+                                   ("flat", flat_http_parser.get_http_request)):
+        for pieces_name, piece_size in (("whole", len(messages)), ("100 B pieces", 100)):
+            pieces = [messages[i:i + piece_size] for i in range(0, len(messages), piece_size)]
+            parser = intialize_parser(get_http_request)
+            seconds = min(timeit.repeat(lambda: [list(parse(parser, piece)) for piece in pieces], number=1, repeat=5))
+            report("http %s, %s" % (name, pieces_name), seconds, 1000, "messages")
+
+    parser = intialize_parser(http_parser.get_http_request)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    retained = list(parse(parser, messages))
+    retained_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print("%-40s %10.0f bytes/message" % ("retained messages", retained_bytes / len(retained)))
+
+
+def compare_batch(name, prepare_parse, prepare_batch, pieces, count):
+    """Time parsing the pieces one result per resumption (parse) and all results per piece at once (feed)"""
+    def run_parse():
+        parser = prepare_parse()
+        return [list(parse(parser, piece)) for piece in pieces]
+
+    def run_feed():
+        parser = prepare_batch()
+        return [feed(parser, piece) for piece in pieces]
+
+    for mode, run in (("parse", run_parse), ("feed", run_feed)):
+        seconds = min(timeit.repeat(run, number=1, repeat=5))
+        report("%s, %s" % (name, mode), seconds, count, "records")
+
+
+def primed(parser):
+    next(parser)
+    return parser
+
+
+@benchmark
+def bench_batch_feed():
+    """Many small records per buffer, where resuming the parser per record dominates"""
+    records = 200
+    pieces = 100
+
+    pipelined = b"GET /a HTTP/1.1\r\nHost: x\r\n\r\n" * records
+    for name, get_http_request in (("combinators", http_parser.get_http_request),
+                                   ("flat", flat_http_parser.get_http_request)):
+        compare_batch("pipelined http %s" % name, lambda: intialize_parser(get_http_request),
+                      lambda: intialize_parser(get_http_request, batch=True), [pipelined] * pieces, records * pieces)
+
+    chunked = "5\r\nabcde" * records
+    compare_batch("chunking", lambda: primed(chunking_parser.prepare()),
+                  lambda: primed(chunking_parser.prepare(batch=True)), [chunked] * pieces, records * pieces)
+
+    delimited = "abcde." * records
+    compare_batch("delimiting", lambda: primed(delimiting_parser.prepare(".")),
+                  lambda: primed(delimiting_parser.prepare(".", batch=True)), [delimited] * pieces, records * pieces)
+
+
+@benchmark
+def bench_offline_parse():
+    """Recorded connections parsed by one process and by a pool of one per CPU"""
+    exchanges = 2000
+    request = b"GET /some/path HTTP/1.1\r\nHost: www.example.com\r\nAccept: */*\r\n\r\n"
+    with tempfile.TemporaryDirectory() as directory:
+        for connection in range(32):
+            for extension, message in ((".request", request), (".response", RESPONSE)):
+                with open(os.path.join(directory, "%d%s" % (connection, extension)), "wb") as f:
+                    f.write(message * exchanges)
+        connections = offline.find_connections(directory)
+
+        for workers in sorted({1, os.cpu_count() or 1}):
+            start = time.perf_counter()
+            for _ in offline.parse_connections(connections, workers):
+                pass
+            seconds = time.perf_counter() - start
+            report("offline parse, %d workers" % workers, seconds, len(connections) * exchanges, "exchanges")
+
+
+def receive_all(sock, parser, recv_size, use_recv_into):
+    """Feed everything received on the socket to the parser, return the number of bytes"""
+    total = 0
+    if use_recv_into:
+        recv_buffer = bytearray(recv_size)
+        recv_view = memoryview(recv_buffer)
+        count = sock.recv_into(recv_buffer)
+        while count:
+            total += count
+            for _ in parse(parser, recv_view[:count]):
+                pass
+            count = sock.recv_into(recv_buffer)
+    else:
+        data = sock.recv(recv_size)
+        while data:
+            total += len(data)
+            for _ in parse(parser, data):
+                pass
+            data = sock.recv(recv_size)
+    return total
+
+
+@benchmark
+def bench_recv():
+    body = b"x" * (1024 * 1024)
+    message = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+    for name, recv_size, use_recv_into in (("recv(1024)", 1024, False), ("recv_into, 64 KB", 65536, True)):
+        source, sink = socket.socketpair()
+
+        def send():
+            for _ in range(64):
+                source.sendall(message)
+            source.close()
+
+        sender = threading.Thread(target=send)
+        start = time.perf_counter()
+        sender.start()
+        parser = intialize_parser(http_parser.get_http_frames)
+        total = receive_all(sink, parser, recv_size, use_recv_into)
+        seconds = time.perf_counter() - start
+        sender.join()
+        sink.close()
+        report("loopback parse, %s" % name, seconds, total / (1024 * 1024), "MB")
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,91 @@
+"""
+Sinks for captured request/response pairs.
+
+Sinks are handed RequestResponse objects on the forwarding path and do all formatting and writing
+on a background thread, so that a slow terminal or log file never stalls a proxied connection.
+"""
+
+import atexit
+import queue
+import sys
+from threading import Lock, Thread
+
+import http_parser
+
+
+class CaptureSink:
+    """
+    Writes request/response pairs from a background thread, through a queue of at most max_pending entries.
+
+    When the queue is full, put() either drops the entry (when_full='drop', counted in dropped) or waits
+    for the writer to catch up (when_full='block').
+    """
+
+    def __init__(self, max_pending=1000, when_full='drop'):
+        if when_full not in ('drop', 'block'):
+            raise ValueError("when_full must be 'drop' or 'block', not %r" % when_full)
+        self.queue = queue.Queue(max_pending)
+        self.block = when_full == 'block'
+        self.dropped = 0
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, request_response):
+        if self.block:
+            self.queue.put(request_response)
+            return
+        try:
+            self.queue.put_nowait(request_response)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        request_response = self.queue.get()
+        while request_response is not None:
+            try:
+                self.write(request_response)
+            except Exception as ex:
+                print(ex, file=sys.stderr)
+            request_response = self.queue.get()
+        self.flush()
+
+    def write(self, request_response):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self, timeout=None):
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+
+class TextCaptureSink(CaptureSink):
+    """
+    Writes the human-readable form of each pair to a text stream, stdout by default, with up to
+    preview_length bytes of each body.
+    """
+
+    def __init__(self, stream=None, preview_length=http_parser.PREVIEW_LENGTH, **options):
+        self.stream = stream
+        self.preview_length = preview_length
+        super().__init__(**options)
+
+    def write(self, request_response):
+        stream = self.stream or sys.stdout
+        stream.write(request_response.format(self.preview_length) + "\n")
+        stream.flush()
+
+
+_default_sink = None
+_default_sink_lock = Lock()
+
+
+def default_sink():
+    """The TextCaptureSink to stdout shared by all Communication objects not given a sink"""
+    global _default_sink
+    with _default_sink_lock:
+        if _default_sink is None:
+            _default_sink = TextCaptureSink()
+            atexit.register(_default_sink.close, 5)
+        return _default_sink
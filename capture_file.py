@@ -0,0 +1,208 @@
+"""
+Indexed binary capture files.
+
+A capture is two append-only files. The data file holds one record per captured RequestResponse: the head
+and the body of the request and of the response, each as a segment prefixed with its length (NO_SEGMENT
+for a missing one). The index file, named after the data file with .idx appended, holds one entry per
+record with its guid, timestamps, method, path, status and position in the data file, so that records
+can be looked up and filtered without reading any body.
+
+As with other sinks, a pair is captured each time it changes, so the request of an exchange usually
+appears once alone and once with its response, under the same guid.
+"""
+
+import collections
+import mmap
+import os
+import struct
+import uuid
+
+import http_parser
+from capture import CaptureSink
+from communication import RequestResponse
+
+SEGMENT = struct.Struct("<I")
+NO_SEGMENT = 0xFFFFFFFF
+
+# guid, the four timestamps (-1 when unknown), record offset and length, status, flags, method and path lengths
+INDEX_ENTRY = struct.Struct("<16s4qQIHBBH")
+HAS_REQUEST = 1
+HAS_RESPONSE = 2
+
+CaptureEntry = collections.namedtuple("CaptureEntry", "guid request_first_byte_ns request_forwarded_ns "
+                                                      "response_first_byte_ns response_last_byte_ns "
+                                                      "offset length status has_request has_response method path")
+
+
+def message_segments(message):
+    if message is None:
+        return [SEGMENT.pack(NO_SEGMENT), SEGMENT.pack(NO_SEGMENT)]
+    head = b"".join(message.head_to_bytes())
+    segments = [SEGMENT.pack(len(head)), head]
+    if message.body is None:
+        segments.append(SEGMENT.pack(NO_SEGMENT))
+    else:
+        segments += [SEGMENT.pack(len(message.body)), message.body]
+    return segments
+
+
+def timestamp(value):
+    return -1 if value is None else value
+
+
+class BinaryCaptureSink(CaptureSink):
+    """Appends request/response pairs to an indexed capture file"""
+
+    def __init__(self, path, **options):
+        self.data_file = open(path, "ab")
+        self.index_file = open(path + ".idx", "ab")
+        self.offset = self.data_file.seek(0, os.SEEK_END)
+        super().__init__(**options)
+
+    def write(self, request_response):
+        request, response = request_response.request, request_response.response
+        segments = message_segments(request) + message_segments(response)
+        length = sum(len(segment) for segment in segments)
+
+        method = path = b""
+        if request is not None:
+            # Clipped to fit the index entry, the record keeps them whole
+            method, path = bytes(request.method or b"")[:0xFF], bytes(request.path or b"")[:0xFFFF]
+        status = int(response.status) if response is not None and bytes(response.status).isdigit() else 0
+        if status > 0xFFFF:
+            status = 0
+        flags = (HAS_REQUEST if request is not None else 0) | (HAS_RESPONSE if response is not None else 0)
+        # Packed before anything is written, so that a record that cannot be indexed is not written either
+        entry = INDEX_ENTRY.pack(request_response.guid.bytes,
+                                 timestamp(request_response.request_first_byte_ns),
+                                 timestamp(request_response.request_forwarded_ns),
+                                 timestamp(request_response.response_first_byte_ns),
+                                 timestamp(request_response.response_last_byte_ns),
+                                 self.offset, length, status, flags, len(method), len(path))
+
+        try:
+            self.data_file.writelines(segments)
+            self.index_file.write(entry + method + path)
+        except Exception:
+            # The next record starts wherever writing the data stopped
+            self.offset = self.data_file.tell()
+            raise
+        self.offset += length
+
+    def flush(self):
+        # Data first, so that a flushed index entry never points past the flushed data
+        self.data_file.flush()
+        self.index_file.flush()
+
+    def close(self, timeout=None):
+        super().close(timeout)
+        self.data_file.close()
+        self.index_file.close()
+
+
+class CaptureReader:
+    """
+    Random access to the records of a capture file.
+
+    The index is read into memory and the data file is memory-mapped, records are only parsed by load().
+    """
+
+    def __init__(self, path):
+        with open(path + ".idx", "rb") as f:
+            self.entries = list(read_index(f.read()))
+        self.data_file = open(path, "rb")
+        self.data = None
+        if os.fstat(self.data_file.fileno()).st_size:
+            self.data = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        # An entry whose record was not flushed yet is left out
+        size = len(self.data) if self.data is not None else 0
+        self.entries = [entry for entry in self.entries if entry.offset + entry.length <= size]
+        self.by_guid = {entry.guid: entry for entry in self.entries}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        return self.entries[index]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def get(self, guid):
+        """The last entry captured for the guid, None if there is none"""
+        return self.by_guid.get(guid)
+
+    def filter(self, method=None, path=None, status=None, complete=False, since_ns=None, until_ns=None):
+        """
+        Entries matching all the criteria given: the method, a path prefix, the status, having both
+        messages, and the request starting to arrive within [since_ns, until_ns).
+        """
+        for entry in self.entries:
+            if method is not None and entry.method != method:
+                continue
+            if path is not None and not entry.path.startswith(path):
+                continue
+            if status is not None and entry.status != status:
+                continue
+            if complete and not (entry.has_request and entry.has_response):
+                continue
+            if since_ns is not None and (entry.request_first_byte_ns is None or entry.request_first_byte_ns < since_ns):
+                continue
+            if until_ns is not None and (entry.request_first_byte_ns is None or entry.request_first_byte_ns >= until_ns):
+                continue
+            yield entry
+
+    def load(self, entry):
+        """The RequestResponse recorded by the entry, with its messages parsed"""
+        offset = entry.offset
+        messages = []
+        for _ in range(2):
+            head, offset = self.read_segment(offset)
+            body, offset = self.read_segment(offset)
+            message = None
+            if head is not None:
+                message = http_parser.parse_head(head)
+                message.body = body
+            messages.append(message)
+
+        request_response = RequestResponse(*messages)
+        request_response.guid = entry.guid
+        request_response.request_first_byte_ns = entry.request_first_byte_ns
+        request_response.request_forwarded_ns = entry.request_forwarded_ns
+        request_response.response_first_byte_ns = entry.response_first_byte_ns
+        request_response.response_last_byte_ns = entry.response_last_byte_ns
+        return request_response
+
+    def read_segment(self, offset):
+        length, = SEGMENT.unpack_from(self.data, offset)
+        offset += SEGMENT.size
+        if length == NO_SEGMENT:
+            return None, offset
+        return self.data[offset:offset + length], offset + length
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+        self.data_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_index(index):
+    position = 0
+    while position + INDEX_ENTRY.size <= len(index):
+        guid, request_first, request_forwarded, response_first, response_last, offset, length, status, flags, \
+            method_length, path_length = INDEX_ENTRY.unpack_from(index, position)
+        position += INDEX_ENTRY.size
+        if position + method_length + path_length > len(index):
+            break
+        method = index[position:position + method_length]
+        path = index[position + method_length:position + method_length + path_length]
+        position += method_length + path_length
+        yield CaptureEntry(uuid.UUID(bytes=guid), *(None if value < 0 else value for value in
+                                                    (request_first, request_forwarded, response_first, response_last)),
+                           offset, length, status, bool(flags & HAS_REQUEST), bool(flags & HAS_RESPONSE), method, path)
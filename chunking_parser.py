@@ -1,8 +1,10 @@
+from parser_utils import Buffer, get_bytes, get_more, get_until
+
 CRLF = "\r\n"
 
 
-def prepare():
-    data = yield None
+def prepare(batch=False):
+    data = Buffer((yield None), batch=batch)
     while True:
         first_line, data = yield from get_line(data)
         count = int(first_line)
@@ -12,22 +14,4 @@ def prepare():
 
 
 def get_line(data):
-    index = -1
-    while index < 0:
-        index = data.find(CRLF)
-        if index < 0:
-            data = yield from get_more(data)
-
-    return data[:index], data[index + 2:]
-
-
-def get_bytes(data, count):
-    while (len(data) < count):
-        data = yield from get_more(data)
-
-    return data[:count], data[count:]
-
-
-def get_more(data, result=None):
-    moredata = yield result
-    return data + moredata if moredata else data
+    return get_until(data, CRLF)
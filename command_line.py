@@ -0,0 +1,56 @@
+"""
+The command line options shared by the threaded and the asyncio Pinhole.
+"""
+
+import atexit
+import functools
+
+import capture_file
+import latency
+from communication import Communication
+from pipe import PipeThread
+
+
+def parse_command_line(argv):
+    options = {}
+    for flag, option in (('--stream', 'streaming'), ('--zero-copy', 'zero_copy'), ('--raw', 'raw'),
+                         ('--pool', 'pool'), ('--stats', 'instrumented')):
+        if flag in argv:
+            argv = [arg for arg in argv if arg != flag]
+            options[option] = True
+    for name in ('recv-size', 'capture-body-limit', 'high-water', 'low-water', 'max-line', 'max-headers',
+                 'max-body-in-memory', 'backlog', 'workers'):
+        for arg in [arg for arg in argv if arg.startswith('--%s=' % name)]:
+            options[name.replace('-', '_')] = int(arg.split('=', 1)[1])
+            argv = [other for other in argv if other != arg]
+    for name in ('latency-file', 'capture-file'):
+        for arg in [arg for arg in argv if arg.startswith('--%s=' % name)]:
+            options[name.replace('-', '_')] = arg.split('=', 1)[1]
+            argv = [other for other in argv if other != arg]
+
+    if len(argv) > 1:
+        port = newport = int(argv[1])
+        newhost = argv[2]
+        if len(argv) == 4: newport = int(argv[3])
+        return port, newhost, newport, options
+    else:
+        return 8003, 'www.example.com', 80, options
+
+
+def print_parser_stats(stats):
+    print('Parser stats %s' % stats)
+
+
+def setup_outputs(options):
+    """
+    Turn the latency_file and capture_file options into what they write to, both closed on exit,
+    and have the parser counters of all connections printed on exit if instrumented
+    """
+    if options.get('instrumented'):
+        atexit.register(lambda: print_parser_stats(PipeThread.parser_stats_total()))
+    if 'latency_file' in options:
+        atexit.register(latency.default_recorder().dump, options.pop('latency_file'))
+    if 'capture_file' in options:
+        sink = capture_file.BinaryCaptureSink(options.pop('capture_file'))
+        atexit.register(sink.close, 5)
+        options['communication_class'] = functools.partial(Communication, sink=sink)
@@ -0,0 +1,105 @@
+"""
+Pairing of the requests and responses of a connection into the exchanges that are captured.
+"""
+
+import collections
+import copy
+import uuid
+
+import capture
+import http_parser
+import latency
+
+# When the first byte of a message was received and its last byte forwarded, in time.monotonic_ns()
+MessageTiming = collections.namedtuple("MessageTiming", "first_byte_ns last_byte_ns upstream")
+
+
+class RequestResponse:
+    def __init__(self, request=None, response=None):
+        self.guid = uuid.uuid4()
+        self.response = response
+        self.request = request
+        self.upstream = None
+        self.request_first_byte_ns = None
+        self.request_forwarded_ns = None
+        self.response_first_byte_ns = None
+        self.response_last_byte_ns = None
+
+    def upstream_latency_ns(self):
+        """Time from forwarding the request to receiving the response, None until both are known"""
+        if self.request_forwarded_ns is None or self.response_first_byte_ns is None:
+            return None
+        return self.response_first_byte_ns - self.request_forwarded_ns
+
+    def snapshot(self):
+        """A copy to hand to a capture sink, unaffected by the pair being completed later"""
+        return copy.copy(self)
+
+    def format(self, preview_length=http_parser.PREVIEW_LENGTH):
+        s = "====================================================\n"
+        s += "Communication " + str(self.guid) + "\n"
+        s += "REQUEST:\n"
+        s += format_message(self.request, preview_length) + "\n"
+        s += "RESPONSE:\n"
+        s += format_message(self.response, preview_length) + "\n"
+        s += "====================================================\n"
+        return s
+
+    def __str__(self):
+        return self.format()
+
+
+def format_message(message, preview_length):
+    return str(message) if message is None else message.format(preview_length)
+
+
+class Communication:
+    def __init__(self, sink=None, latencies=None):
+        self.pending_requests = collections.deque()
+        self.pending_responses = collections.deque()
+        self.sink = sink or capture.default_sink()
+        self.latencies = latencies or latency.default_recorder()
+
+    def add_message(self, message, tag, timing=None):
+        if tag == "request":
+            self.add_request(message, timing)
+        elif tag == "response":
+            self.add_response(message, timing)
+        else:
+            raise Exception("Unknown tag " + tag)
+
+    def add_request(self, request, timing=None):
+        if self.pending_responses:
+            request_response = self.pending_responses.popleft()
+            request_response.request = request
+        else:
+            request_response = RequestResponse(request=request)
+            self.pending_requests.append(request_response)
+        if timing is not None:
+            request_response.upstream = timing.upstream
+            request_response.request_first_byte_ns = timing.first_byte_ns
+            request_response.request_forwarded_ns = timing.last_byte_ns
+            self.record_latency(request_response)
+        self.have_request_response(request_response)
+
+    def add_response(self, response, timing=None):
+        if self.pending_requests:
+            request_response = self.pending_requests.popleft()
+            request_response.response = response
+        else:
+            request_response = RequestResponse(response=response)
+            self.pending_responses.append(request_response)
+        if timing is not None:
+            request_response.upstream = timing.upstream
+            request_response.response_first_byte_ns = timing.first_byte_ns
+            request_response.response_last_byte_ns = timing.last_byte_ns
+            self.record_latency(request_response)
+        self.have_request_response(request_response)
+
+    def record_latency(self, request_response):
+        latency_ns = request_response.upstream_latency_ns()
+        if latency_ns is not None:
+            self.latencies.record(request_response.upstream, latency_ns)
+
+    def have_request_response(self, request_response):
+        self.sink.put(request_response.snapshot())
@@ -0,0 +1,86 @@
+"""
+Decoding of message bodies sent with a Content-Encoding, for display.
+
+Only as much of a body is inflated as is shown: a BodyDecoder is fed the body fragment by fragment
+and stops as soon as it has decoded limit bytes, leaving the rest of the input alone.
+"""
+
+import zlib
+
+ENCODINGS = (b"gzip", b"x-gzip", b"deflate")
+
+
+def wbits(encoding, start):
+    if encoding != b"deflate":
+        return 16 + zlib.MAX_WBITS
+    # deflate should have a zlib header, but some servers send a raw deflate stream
+    if len(start) >= 2 and start[0] & 0x0F == 8 and (start[0] * 256 + start[1]) % 31 == 0:
+        return zlib.MAX_WBITS
+    return -zlib.MAX_WBITS
+
+
+class BodyDecoder:
+    """Inflates the fragments of a gzip or deflate body, keeping the first limit bytes decoded"""
+
+    def __init__(self, encoding, limit):
+        if encoding not in ENCODINGS:
+            raise ValueError("Unsupported Content-Encoding %r" % encoding)
+        self.encoding = encoding
+        self.limit = limit
+        self.decoded = b""
+        self.decompressor = None
+        # The first byte, held back until the second tells the format
+        self.start = b""
+        # Whether the body decodes to more than limit bytes
+        self.truncated = False
+        self.failed = False
+
+    @property
+    def done(self):
+        return self.truncated or self.failed or (self.decompressor is not None and self.decompressor.eof)
+
+    def feed(self, fragment):
+        """Decode the next fragment of the body, return whether more are wanted"""
+        if self.done or not fragment:
+            return not self.done
+        if self.decompressor is None:
+            if len(self.start) + len(fragment) < 2:
+                self.start += bytes(fragment)
+                return True
+            start, self.start = self.start, b""
+            self.decompressor = zlib.decompressobj(wbits(self.encoding, start + bytes(fragment[:2 - len(start)])))
+            if start and not self.decompress(start):
+                return False
+        return self.decompress(fragment)
+
+    def decompress(self, data):
+        try:
+            # One byte more than kept tells whether there is more
+            self.decoded += self.decompressor.decompress(data, self.limit + 1 - len(self.decoded))
+        except zlib.error:
+            self.failed = True
+            return False
+        if len(self.decoded) > self.limit:
+            self.decoded = self.decoded[:self.limit]
+            self.truncated = True
+        return not self.done
+
+
+def preview(body, encoding, limit):
+    """
+    The first limit bytes of the body, decoded if it has a Content-Encoding (None for identity),
+    and whether there is more, as there is when the body ends before its encoded stream does;
+    None if the body cannot be decoded.
+    """
+    if encoding is None or encoding == b"identity":
+        return bytes(body[:limit]), len(body) > limit
+    if encoding not in ENCODINGS:
+        return None
+    decoder = BodyDecoder(encoding, limit)
+    with memoryview(body) as view:
+        decoder.feed(view)
+    if decoder.failed:
+        return None
+    # Only the start of the body may have been captured
+    ended = decoder.decompressor is not None and decoder.decompressor.eof
+    return decoder.decoded, decoder.truncated or (len(body) > 0 and not ended)
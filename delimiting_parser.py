@@ -3,8 +3,17 @@ This is a first generator-based parser
 """
 
 
-def prepare(delimiter):
+def prepare(delimiter, batch=False):
     data = yield None
+    if batch:
+        while True:
+            # Every complete record at once, the unterminated tail stays buffered
+            *results, data = data.split(delimiter)
+            moredata = yield results
+
+            if moredata:
+                data = data + moredata
+
     while True:
         index = data.find(delimiter)
         if index >= 0:
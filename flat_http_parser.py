@@ -0,0 +1,135 @@
+"""
+HTTP parser written as one flat state machine.
+
+get_http_request here produces the same HttpRequest/HttpResponse objects as http_parser.get_http_request
+and plugs into intialize_parser/parse the same way, but each message is parsed by a single generator
+frame instead of a chain of nested ones, so resuming it on new data is one frame switch.
+
+The first line is split on whitespace once it is complete, so empty lines before a message are skipped.
+The limits of the buffer, http_parser.HttpLimits, are applied as by http_parser.
+"""
+
+from http_parser import limit, parse_chunk_size, parse_first_line, parse_header_block
+from parser_utils import SpooledBytes, check_limit
+
+FIRST_LINE, HEADERS, BODY, CHUNK_SIZE, CHUNK_DATA, CHUNK_END, TRAILERS, REST = range(8)
+
+
+def get_http_request(data):
+    state = FIRST_LINE
+    message = None
+    # How far the current search got, so that new data resumes it instead of restarting it
+    scanned = 0
+    # Where the header line not checked against max_line yet starts
+    line_start = 0
+    remaining = 0
+    body = None
+    max_line, max_headers = limit(data, "max_line"), limit(data, "max_headers")
+    max_body = limit(data, "max_body_in_memory")
+
+    while True:
+        if state == FIRST_LINE:
+            index = data.find(b"\r\n", scanned)
+            if index >= 0:
+                check_limit(index, max_line)
+                message = parse_first_line(data.take(index))
+                data.skip(2)
+                scanned = 0
+                if message is None:
+                    continue
+                state = HEADERS
+                continue
+            check_limit(len(data), max_line)
+            scanned = max(len(data) - 1, 0)
+
+        elif state == HEADERS or state == TRAILERS:
+            if len(data) >= 2 and data[0] == 13 and data[1] == 10:
+                end = 0
+            else:
+                end = data.find(b"\r\n\r\n", scanned)
+                end = end + 2 if end >= 0 else -1
+            if end >= 0:
+                check_limit(end - 2, max_headers)
+                fields = parse_header_block(data.take(end, data.zero_copy), max_line)
+                data.skip(2)
+                scanned = line_start = 0
+                if state == TRAILERS:
+                    message.trailers = fields
+                    message.body = body.getvalue()
+                    return message, data
+                message.headers = fields
+                if not message.has_body():
+                    return message, data
+                if b"Content-Length" in message.headers:
+                    remaining = int(message.headers[b"Content-Length"])
+                    # A body too long to keep in memory is spooled to a file as it arrives
+                    body = SpooledBytes(0) if max_body is not None and remaining > max_body else None
+                    state = BODY
+                elif message.is_chunked():
+                    body = SpooledBytes(max_body)
+                    state = CHUNK_SIZE
+                else:
+                    state = REST
+                continue
+            check_limit(len(data), max_headers)
+            if max_line is not None:
+                # The lines of an unfinished block are checked as they arrive
+                index = data.find(b"\r\n", line_start)
+                while index >= 0:
+                    check_limit(index - line_start, max_line)
+                    line_start = index + 2
+                    index = data.find(b"\r\n", line_start)
+                check_limit(len(data) - line_start, max_line)
+            scanned = max(len(data) - 3, 0)
+
+        elif state == BODY:
+            if body is None and len(data) >= remaining:
+                message.body = data.take(remaining, data.zero_copy)
+                return message, data
+            if body is not None:
+                piece = data.take(remaining)
+                body.write(piece)
+                remaining -= len(piece)
+                if not remaining:
+                    message.body = body.getvalue()
+                    return message, data
+
+        elif state == CHUNK_SIZE or state == CHUNK_END:
+            index = data.find(b"\r\n", scanned)
+            if index >= 0:
+                check_limit(index, max_line)
+                line = data.take(index)
+                data.skip(2)
+                scanned = 0
+                if state == CHUNK_END:
+                    state = CHUNK_SIZE
+                else:
+                    remaining = parse_chunk_size(line)
+                    state = CHUNK_DATA if remaining > 0 else TRAILERS
+                continue
+            check_limit(len(data), max_line)
+            scanned = max(len(data) - 1, 0)
+
+        elif state == CHUNK_DATA:
+            piece = data.take(remaining)
+            body.write(piece)
+            remaining -= len(piece)
+            if not remaining:
+                state = CHUNK_END
+                continue
+
+        elif state == REST:
+            # Like get_rest: the body is what arrives until a resumption brings no data
+            moredata = yield data.take_batch()
+            data.extend(moredata)
+            if body is None and max_body is not None and len(data) > max_body:
+                body = SpooledBytes(0)
+            if body is not None:
+                body.write(data.take_all())
+            if not moredata:
+                message.body = data.take_all(data.zero_copy) if body is None else body.getvalue()
+                return message, data
+            continue
+
+        moredata = yield data.take_batch()
+        data.extend(moredata)
@@ -1,40 +1,256 @@
-from parser_utils import get_bytes, get_more, get_word, get_rest, get_until
+import collections
+import copy
+import mmap
+import re
+from array import array
+
+import content_decoding
+from parser_utils import LimitExceeded, SpooledBytes, check_limit, find_delimiter, get_bytes, get_more, get_word, \
+    get_rest, get_until, skip_bytes, spool_bytes
 
 CRLF = "\r\n"
 
+# How much of a body is shown by str()
+PREVIEW_LENGTH = 75
+
+# Whitespace stripped from the start of a header value
+_VALUE_SPACE = re.compile(b"[ \t\x0b\x0c]*")
+_VALUE_SPACE_BYTES = (b" ", b"\t", b"\x0b", b"\x0c")
+_OBS_FOLD = re.compile(b"[ \t]*\r\n[ \t]+")
+
+# Limits on what the parser keeps in memory, set as the limits of the Buffer parsed, None for no bound.
+# A line or header block going beyond its limit raises LimitExceeded, a body beyond max_body_in_memory
+# is spooled to a temporary file and memory-mapped.
+HttpLimits = collections.namedtuple("HttpLimits", "max_line max_headers max_body_in_memory",
+                                    defaults=(None, None, None))
+
+
+class Headers:
+    """
+    Header fields of a message, kept as the raw header block and the offsets of each name and value in it.
+
+    Names and values are sliced out of the block only when accessed, and names are matched case-insensitively.
+    When the same name occurs more than once, lookups return the last value. Values continued on
+    obs-fold lines are returned with each fold replaced by a space. The first change turns the headers
+    into a plain list of (name, value) pairs.
+    """
+    __slots__ = ("raw", "offsets", "fields", "folded")
+
+    def __init__(self, raw=b"", offsets=None, folded=False):
+        self.raw = raw
+        # name start, name end, value start, value end for each field
+        self.offsets = array("I") if offsets is None else offsets
+        self.fields = None
+        self.folded = folded
+
+    def __len__(self):
+        if self.fields is not None:
+            return len(self.fields)
+        return len(self.offsets) // 4
+
+    def __iter__(self):
+        for name, _ in self.items():
+            yield name
+
+    def __contains__(self, name):
+        return self._find(name) >= 0
+
+    def __getitem__(self, name):
+        index = self._find(name)
+        if index < 0:
+            raise KeyError(name)
+        return self._value(index)
+
+    def __setitem__(self, name, value):
+        index = self._find(name)
+        fields = self._fields()
+        if index < 0:
+            fields.append((name, value))
+        else:
+            fields[index] = (fields[index][0], value)
+
+    def __delitem__(self, name):
+        if self._find(name) < 0:
+            raise KeyError(name)
+        name = name.lower()
+        self.fields = [field for field in self._fields() if field[0].lower() != name]
+
+    def __eq__(self, other):
+        if isinstance(other, Headers):
+            other = other.items()
+        elif isinstance(other, dict):
+            other = other.items()
+        else:
+            return NotImplemented
+        return [(bytes(n), bytes(v)) for n, v in self.items()] == [(bytes(n), bytes(v)) for n, v in other]
+
+    def get(self, name, default=None):
+        index = self._find(name)
+        return default if index < 0 else self._value(index)
+
+    def pop(self, name, default=None):
+        value = self.get(name, default)
+        if name in self:
+            del self[name]
+        return value
+
+    def items(self):
+        if self.fields is not None:
+            return list(self.fields)
+        raw, offsets = self.raw, self.offsets
+        return [(bytes(raw[offsets[i]:offsets[i + 1]]), self._unfold(raw[offsets[i + 2]:offsets[i + 3]]))
+                for i in range(0, len(offsets), 4)]
+
+    def field_range(self, name):
+        """
+        Start and end in the raw block of the last field with the name, without its line ending;
+        None if there is no such field or the fields have been changed.
+        """
+        if self.fields is not None:
+            return None
+        index = self._find(name)
+        if index < 0:
+            return None
+        return self.offsets[index * 4], self.offsets[index * 4 + 3]
+
+    def copy(self):
+        headers = Headers(self.raw, self.offsets, self.folded)
+        if self.fields is not None:
+            headers.fields = list(self.fields)
+        return headers
+
+    def detached(self):
+        """A copy not referring to a receive buffer, as needed to pickle it"""
+        headers = Headers(bytes(self.raw), self.offsets, self.folded)
+        if self.fields is not None:
+            headers.fields = [(bytes(name), bytes(value)) for name, value in self.fields]
+        return headers
+
+    def _find(self, name):
+        """Index of the last field with the name, or -1"""
+        name = name.lower()
+        if self.fields is not None:
+            for index in range(len(self.fields) - 1, -1, -1):
+                if self.fields[index][0].lower() == name:
+                    return index
+            return -1
+        raw, offsets = self.raw, self.offsets
+        for start in range(len(offsets) - 4, -1, -4):
+            if offsets[start + 1] - offsets[start] == len(name) and \
+                    bytes(raw[offsets[start]:offsets[start + 1]]).lower() == name:
+                return start // 4
+        return -1
+
+    def _value(self, index):
+        if self.fields is not None:
+            return self.fields[index][1]
+        start = index * 4
+        return self._unfold(self.raw[self.offsets[start + 2]:self.offsets[start + 3]])
+
+    def _unfold(self, value):
+        return _OBS_FOLD.sub(b" ", value) if self.folded else value
+
+    def _fields(self):
+        if self.fields is None:
+            self.fields = self.items()
+            self.raw = b""
+            self.offsets = array("I")
+        return self.fields
+
 
 class HttpMessage:
+    __slots__ = ("version", "headers", "body", "trailers", "head_range", "body_range")
+
     def __init__(self):
         self.version = None
-        self.headers = dict()
+        self.headers = Headers()
         self.body = None
+        # The trailer fields following a chunked body
+        self.trailers = None
+        # (start, end) stream positions, only recorded by get_http_frames
+        self.head_range = None
+        self.body_range = None
+
+    def detached(self):
+        """A copy not referring to a receive buffer, as needed to pickle it"""
+        message = copy.copy(self)
+        message.headers = self.headers.detached()
+        if self.trailers is not None:
+            message.trailers = self.trailers.detached()
+        if isinstance(self.body, (memoryview, mmap.mmap)):
+            message.body = bytes(self.body)
+        return message
 
     def is_text(self):
-        content_type = self.headers.get(b"Content-Type", b"")
+        content_type = bytes(self.headers.get(b"Content-Type", b""))
         return b"text" in content_type or b"xml" in content_type
 
-    def __str__(self):
+    def preview(self, limit=PREVIEW_LENGTH):
+        """
+        The first limit bytes of the body, decoded if sent gzip or deflate encoded, whether there is more
+        and whether they are the content rather than still encoded. Only as much of the body is decoded
+        as is returned.
+        """
+        encoding = self.headers.get(b"Content-Encoding")
+        if encoding is not None:
+            encoding = bytes(encoding).strip().lower()
+        decoded = content_decoding.preview(self.body, encoding, limit)
+        if decoded is None:
+            # A body in an encoding not known or not decoding is shown as it is
+            return bytes(self.body[:limit]), len(self.body) > limit, False
+        return decoded + (True,)
+
+    def format(self, preview_length=PREVIEW_LENGTH):
+        """The message for display, with the first preview_length bytes of its body"""
         data = self.first_line().decode()
         for name, value in self.headers.items():
-            data += "%s: %s\r\n" % (name.decode(), value.decode())
+            data += "%s: %s\r\n" % (bytes(name).decode(), bytes(value).decode())
         data += "\r\n"
-        if self.has_body():
-            if not self.is_text():
-                data += self.body.hex() + "\n"
-            else:
-                data += str(self.body[:75]) + (self.body[75:] and '... (truncated)')
-                data += "\n"
+        if self.has_body() and self.body is not None:
+            preview, truncated, content = self.preview(preview_length)
+            data += str(preview) if content and self.is_text() else preview.hex()
+            data += ('... (truncated)' if truncated else '') + "\n"
 
         return data
 
+    def __str__(self):
+        return self.format()
+
     def to_bytes(self):
-        data = self.first_line()
-        yield data
+        yield from self.head_to_bytes()
+        if self.has_body():
+            yield self.body
+
+    def to_buffers(self):
+        """The serialized message as a list of buffers, to be written with a single gathering send"""
+        return [data for data in self.to_bytes() if data]
+
+    def head_to_bytes(self):
+        yield self.first_line()
         for name, value in self.headers.items():
             yield b"%s: %s\r\n" % (name, value)
         yield b"\r\n"
-        if self.has_body():
-            yield self.body
+
+    def last_chunk_to_bytes(self):
+        """The zero-size chunk ending a chunked body, with the trailers"""
+        yield b"0\r\n"
+        for name, value in (self.trailers or Headers()).items():
+            yield b"%s: %s\r\n" % (name, value)
+        yield b"\r\n"
+
+    def is_chunked(self):
+        return self.headers.get(b"Transfer-Encoding", None) == b"chunked"
+
+    def is_framed(self):
+        """Whether the end of the message is known without the connection being closed"""
+        return not self.has_body() or b"Content-Length" in self.headers or self.is_chunked()
+
+    def is_persistent(self):
+        """Whether the connection stays open after this message"""
+        connection = bytes(self.headers.get(b"Connection", b"")).lower()
+        if self.version == b"HTTP/1.1":
+            return connection != b"close"
+        return connection == b"keep-alive"
 
     def has_body(self):
         pass
@@ -44,6 +260,8 @@ class HttpMessage:
 
 
 class HttpRequest(HttpMessage):
+    __slots__ = ("method", "path")
+
     def __init__(self):
         super().__init__()
         self.method = None
@@ -56,14 +274,58 @@ class HttpRequest(HttpMessage):
         return b"%s %s %s\r\n" % (self.method, self.path, self.version)
 
 
+class HttpHeaders:
+    """Streaming event: the first line and headers of a message have been parsed"""
+    __slots__ = ("message",)
+
+    def __init__(self, message):
+        self.message = message
+
+
+class HttpBodyFragment:
+    """Streaming event: the next piece of the message body, with any chunked framing removed"""
+    __slots__ = ("message", "data")
+
+    def __init__(self, message, data):
+        self.message = message
+        self.data = data
+
+
+class HttpBodySplice:
+    """Streaming event: the next count bytes of the stream are the rest of the body, to be moved by the caller"""
+    __slots__ = ("message", "count")
+
+    def __init__(self, message, count):
+        self.message = message
+        self.count = count
+
+
+class HttpEndOfMessage:
+    """Streaming event: the message is complete"""
+    __slots__ = ("message",)
+
+    def __init__(self, message):
+        self.message = message
+
+
 class HttpResponse(HttpMessage):
+    __slots__ = ("status_message", "status", "request_method")
+
     def __init__(self):
         super().__init__()
         self.status_message = None
         self.status = None
+        # The method of the request answered, when the parser was told it
+        self.request_method = None
 
     def has_body(self):
-        return self.status in (b"200", b"404")  # TODO: Add all codes that have bodies
+        if self.request_method == b"HEAD":
+            return False
+        return not (self.status[:1] == b"1" or self.status in (b"204", b"304"))
+
+    def is_interim(self):
+        """Whether this is a 1xx response, followed by another one to the same request"""
+        return self.status[:1] == b"1"
 
     def first_line(self):
         return b"%s %s %s\r\n" % (self.version, self.status, self.status_message)
@@ -74,18 +336,149 @@ def get_http_request(data):
     message.headers, data = yield from get_headers(data)
     if message.has_body():
         if b"Content-Length" in message.headers:
-            message.body, data = yield from get_bytes(data, int(message.headers[b"Content-Length"]))
-        elif message.headers.get(b"Transfer-Encoding", None) == b"chunked":
-            message.body, data = yield from get_chunked_body(data)
-            # TODO: Parse trailing headers
+            message.body, data = yield from get_bytes(data, int(message.headers[b"Content-Length"]),
+                                                      limit(data, "max_body_in_memory"))
+        elif message.is_chunked():
+            message.body, data = yield from get_chunked_body(data, message)
         else:
-            message.body, data = yield from get_rest(data)
+            message.body, data = yield from get_rest(data, limit(data, "max_body_in_memory"))
 
     return message, data
 
 
-def get_line(data):
-    return get_until(data, b"\r\n")
+def get_http_messages(data, splice=False, stream_above=None, request_method=None):
+    """
+    Like get_http_request, except for messages with a chunked body, which are streamed as by get_http_events:
+    HttpHeaders, an HttpBodyFragment for each piece of a chunk as it arrives, and HttpEndOfMessage.
+
+    With splice set, so are messages with a Content-Length body, which is handed over as by get_spliced_body.
+    With stream_above set, so are those with a Content-Length body longer than that and those with a body
+    running to the end of the stream, so that no more than stream_above bytes of a body are buffered.
+    With request_method set, the messages are responses to a request with that method, which tells
+    whether they have a body.
+    """
+    message, data = yield from get_firstline(data, request_method)
+    message.headers, data = yield from get_headers(data)
+    if message.has_body():
+        if b"Content-Length" in message.headers:
+            count = int(message.headers[b"Content-Length"])
+            if splice:
+                data = yield from get_more(data, HttpHeaders(message))
+                data = yield from get_spliced_body(data, message, count)
+                return HttpEndOfMessage(message), data
+            if stream_above is not None and count > stream_above:
+                data = yield from get_more(data, HttpHeaders(message))
+                data = yield from get_body_fragments(data, message, count)
+                return HttpEndOfMessage(message), data
+            message.body, data = yield from get_bytes(data, count, limit(data, "max_body_in_memory"))
+        elif message.is_chunked():
+            data = yield from get_more(data, HttpHeaders(message))
+            data = yield from get_chunked_body_fragments(data, message)
+            return HttpEndOfMessage(message), data
+        elif stream_above is not None:
+            data = yield from get_more(data, HttpHeaders(message))
+            data = yield from get_rest_fragments(data, message)
+            return HttpEndOfMessage(message), data
+        else:
+            message.body, data = yield from get_rest(data, limit(data, "max_body_in_memory"))
+
+    return message, data
+
+
+def get_http_events(data, splice=False, request_method=None):
+    """
+    Streaming alternative to get_http_request.
+
+    Emits HttpHeaders, then HttpBodyFragment events as body data arrives and finally HttpEndOfMessage,
+    so the body is never buffered as a whole. The message's body stays None.
+    With splice set, a Content-Length body is handed over as by get_spliced_body.
+    request_method is as for get_http_messages.
+    """
+    message, data = yield from get_firstline(data, request_method)
+    message.headers, data = yield from get_headers(data)
+    data = yield from get_more(data, HttpHeaders(message))
+    if message.has_body():
+        if splice and b"Content-Length" in message.headers:
+            data = yield from get_spliced_body(data, message, int(message.headers[b"Content-Length"]))
+        elif b"Content-Length" in message.headers:
+            data = yield from get_body_fragments(data, message, int(message.headers[b"Content-Length"]))
+        elif message.is_chunked():
+            data = yield from get_chunked_body_fragments(data, message)
+        else:
+            data = yield from get_rest_fragments(data, message)
+
+    return HttpEndOfMessage(message), data
+
+
+def get_http_frames(data, request_method=None):
+    """
+    Framing-only alternative to get_http_events.
+
+    Emits HttpHeaders and HttpEndOfMessage with the head_range and body_range of the message filled in,
+    skipping over the body (and any chunked framing) without copying it, so that the original bytes can be
+    forwarded from the buffer. The message's body stays None.
+    request_method is as for get_http_messages.
+    """
+    start = data.position
+    message, data = yield from get_firstline(data, request_method)
+    message.headers, data = yield from get_headers(data)
+    message.head_range = (start, data.position)
+    data = yield from get_more(data, HttpHeaders(message))
+    if message.has_body():
+        if b"Content-Length" in message.headers:
+            data = yield from skip_bytes(data, int(message.headers[b"Content-Length"]))
+        elif message.is_chunked():
+            data = yield from skip_chunked_body(data, message)
+        else:
+            data = yield from skip_rest(data)
+    message.body_range = (message.head_range[1], data.position)
+
+    return HttpEndOfMessage(message), data
+
+
+def parse_first_line(line):
+    """The message started by a complete first line, without its CRLF, or None for an empty line"""
+    words = bytes(line).split(None, 2)
+    if not words:
+        return None
+    method = words[0].upper()
+    version = parse_http_version(method)
+    if len(words) < (2 if version else 3):
+        raise ValueError("Malformed first line")
+    if version:
+        message = HttpResponse()
+        message.version = version
+        message.status = words[1]
+        message.status_message = words[2] if len(words) > 2 else b""
+    else:
+        message = HttpRequest()
+        message.method = method
+        message.path = words[1]
+        message.version = parse_http_version(words[2])
+    return message
+
+
+def parse_head(head):
+    """The message with the complete head given (first line, headers and the empty line), without a body"""
+    head = bytes(head)
+    end = head.find(b"\r\n")
+    message = parse_first_line(head[:end])
+    message.headers = parse_header_block(head[end + 2:-2])
+    return message
+
+
+def limit(data, name):
+    """The limit of the name set for the data, None if there is none"""
+    return None if data.limits is None else getattr(data.limits, name)
+
+
+def remaining(data, end):
+    """How much may be read before the stream position end, None if end is"""
+    return None if end is None else end - data.position
+
+
+def get_line(data, max_line=None):
+    return get_until(data, b"\r\n", max_line if max_line is not None else limit(data, "max_line"))
 
 
 def parse_http_version(version):
@@ -95,15 +488,19 @@ def parse_http_version(version):
         return None
 
 
-def get_firstline(data):
-    method, data = yield from get_word(data)
+def get_firstline(data, request_method=None):
+    # The stream position the line must end by, with its CRLF
+    max_line = limit(data, "max_line")
+    end = None if max_line is None else data.position + max_line + 2
+    method, data = yield from get_word(data, max_line)
     method = method.upper()
     version = parse_http_version(method)
     if version:
         response = HttpResponse()
         response.version = version
-        response.status, data = yield from get_word(data)
-        response.status_message, data = yield from get_line(data)
+        response.request_method = request_method
+        response.status, data = yield from get_word(data, remaining(data, end))
+        response.status_message, data = yield from get_line(data, remaining(data, end))
 
         response.status = response.status
         response.status_message = response.status_message
@@ -112,43 +509,177 @@ def get_firstline(data):
     else:
         request = HttpRequest()
         request.method = method
-        path, data = yield from get_word(data)
+        path, data = yield from get_word(data, remaining(data, end))
         request.path = path
-        version_str, data = yield from get_word(data)
+        version_str, data = yield from get_word(data, remaining(data, end))
         request.version = parse_http_version(version_str)
         return request, data
 
 
 def get_headers(data):
-    headers = {}
-    line, data = yield from get_line(data)
-    name = None
-    value = None
-    while line:
-        if line[0] in (b" ", b"\t") and name:
-            # TODO: Double check this logic here, it may leave unwanted characters
-            value = value + line
-            headers[name] = value
+    if len(data) >= 2 and data[0] == 13 and data[1] == 10:
+        end = 0
+    else:
+        end = data.find(b"\r\n\r\n") + 2
+        if end < 2:
+            return (yield from get_headers_incrementally(data))
+
+    # The whole block is buffered already, which is the usual case
+    check_limit(end - 2, limit(data, "max_headers"))
+    headers = parse_header_block(data.take(end, data.zero_copy), limit(data, "max_line"))
+    data.skip(2)
+    return headers, data
+
+
+def parse_header_block(raw, max_line=None):
+    block = bytes(raw)
+    offsets = array("I")
+    folded = False
+    position = 0
+    for line in block.split(b"\r\n")[:-1]:
+        check_limit(len(line), max_line)
+        if line[:1] in (b" ", b"\t") and offsets:
+            # obs-fold: the line continues the previous value
+            offsets[-1] = position + len(line)
+            folded = True
+        else:
+            colon = line.find(b":")
+            if colon <= 0:
+                raise ValueError("Malformed header line")
+            value_start = colon + 1
+            while line[value_start:value_start + 1] in _VALUE_SPACE_BYTES:
+                value_start += 1
+            offsets.extend((position, position + colon, position + value_start, position + len(line)))
+        position += len(line) + 2
+
+    return Headers(raw, offsets, folded)
+
+
+def get_headers_incrementally(data):
+    offsets = array("I")
+    folded = False
+    start = 0
+    max_line, max_headers = limit(data, "max_line"), limit(data, "max_headers")
+    index, data = yield from find_delimiter(data, b"\r\n", 0, header_line_limit(start, max_line, max_headers))
+    while index > start:
+        if data[start] in b" \t" and offsets:
+            # obs-fold: the line continues the previous value
+            offsets[-1] = index
+            folded = True
         else:
-            name, value = line.split(b":", 1)
-            headers[name] = value.lstrip()
-        line, data = yield from get_line(data)
+            colon = data.find(b":", start)
+            if not start < colon < index:
+                raise ValueError("Malformed header line")
+            value_start = data.match_end(_VALUE_SPACE, colon + 1, index)
+            offsets.extend((start, colon, value_start, index))
+        start = index + 2
+        index, data = yield from find_delimiter(data, b"\r\n", start, header_line_limit(start, max_line, max_headers))
+
+    raw = data.take(start, data.zero_copy)
+    data.skip(2)
+    return Headers(raw, offsets, folded), data
+
+
+def header_line_limit(start, max_line, max_headers):
+    """How far the end of a header line starting at start may be from the start of the block"""
+    if max_line is None:
+        return max_headers
+    if max_headers is None:
+        return start + max_line
+    return min(start + max_line, max_headers)
 
-    return headers, data
 
+def parse_chunk_size(line):
+    # Chunk extensions, after a semicolon, are ignored
+    return int(bytes(line).split(b";", 1)[0], 16)
 
-def get_chunked_body(data):
+
+def get_chunked_body(data, message):
     chunk_size, data = yield from get_line(data)
-    chunk_size = int(chunk_size, 16)
-    body = []
+    chunk_size = parse_chunk_size(chunk_size)
+    body = SpooledBytes(limit(data, "max_body_in_memory"))
     while chunk_size > 0:
-        chunk, data = yield from get_bytes(data, int(chunk_size))
-        body.append(chunk)
+        data = yield from spool_bytes(data, chunk_size, body)
         _, data = yield from get_line(data)  # read the trailing CRLF
         chunk_size, data = yield from get_line(data)
-        chunk_size = int(chunk_size, 16)
+        chunk_size = parse_chunk_size(chunk_size)
+
+    message.trailers, data = yield from get_headers(data)
+
+    return body.getvalue(), data
+
+
+def get_body_fragments(data, message, count):
+    while count > 0:
+        while not data:
+            data = yield from get_more(data)
+        fragment = data.take(count)
+        count -= len(fragment)
+        data = yield from get_more(data, HttpBodyFragment(message, fragment))
+
+    return data
+
+
+def get_spliced_body(data, message, count):
+    """
+    Emits the part of a body of count bytes already received as an HttpBodyFragment and the rest as an
+    HttpBodySplice. The caller moves those bytes from the stream itself, without feeding them to the
+    parser, which then goes on with the next message.
+    """
+    if data:
+        fragment = data.take(count)
+        count -= len(fragment)
+        data = yield from get_more(data, HttpBodyFragment(message, fragment))
+    if count:
+        data = yield from get_more(data, HttpBodySplice(message, count))
+
+    return data
+
+
+def get_chunked_body_fragments(data, message):
+    chunk_size, data = yield from get_line(data)
+    chunk_size = parse_chunk_size(chunk_size)
+    while chunk_size > 0:
+        data = yield from get_body_fragments(data, message, chunk_size)
+        _, data = yield from get_line(data)  # read the trailing CRLF
+        chunk_size, data = yield from get_line(data)
+        chunk_size = parse_chunk_size(chunk_size)
+
+    message.trailers, data = yield from get_headers(data)
+
+    return data
+
+
+def get_rest_fragments(data, message):
+    # Unlike get_rest, only an empty read (end of stream) ends the body; None just means no new data
+    while True:
+        if data:
+            data = yield from get_more(data, HttpBodyFragment(message, data.take_all()))
+        else:
+            moredata = yield data.take_batch()
+            if moredata is not None and not moredata:
+                return data
+            data.extend(moredata)
+
+
+def skip_chunked_body(data, message):
+    chunk_size, data = yield from get_line(data)
+    chunk_size = parse_chunk_size(chunk_size)
+    while chunk_size > 0:
+        data = yield from skip_bytes(data, chunk_size + 2)  # with the trailing CRLF
+        chunk_size, data = yield from get_line(data)
+        chunk_size = parse_chunk_size(chunk_size)
+
+    message.trailers, data = yield from get_headers(data)
+
+    return data
 
-    assert chunk_size == 0
-    _, data = yield from get_line(data)  # read the trailing CRLF
 
-    return b"".join(body), data
+def skip_rest(data):
+    # Like get_rest_fragments, the body ends with an empty read
+    while True:
+        data.skip(len(data))
+        moredata = yield data.take_batch()
+        if moredata is not None and not moredata:
+            return data
+        data.extend(moredata)
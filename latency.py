@@ -0,0 +1,116 @@
+"""
+Latency histograms of the exchanges going through the proxy, one per upstream.
+
+Values are kept in log-linear buckets, as in an HDR histogram: exact below 128 and within 1/64 of the
+recorded value above, so a histogram takes a few kilobytes whatever the number and range of values.
+"""
+
+import json
+from threading import Lock
+
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS >> 1
+
+
+def bucket_index(value):
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return SUB_BUCKETS + (shift - 1) * HALF_SUB_BUCKETS + (value >> shift) - HALF_SUB_BUCKETS
+
+
+def bucket_value(index):
+    """The highest value falling into the bucket"""
+    if index < SUB_BUCKETS:
+        return index
+    shift = (index - SUB_BUCKETS) // HALF_SUB_BUCKETS + 1
+    mantissa = (index - SUB_BUCKETS) % HALF_SUB_BUCKETS + HALF_SUB_BUCKETS
+    return ((mantissa + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        value = max(int(value), 0)
+        index = bucket_index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def add(self, other):
+        """Add the values recorded in another histogram, such as one of another process"""
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, percent):
+        """The value below or at which percent of the recorded values are, None if there are none"""
+        if not self.count:
+            return None
+        rank = max(percent * self.count / 100.0, 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {"count": self.count, "p50": self.percentile(50), "p99": self.percentile(99),
+                "p999": self.percentile(99.9), "max": self.max}
+
+
+class LatencyRecorder:
+    """Latency histograms by upstream, in nanoseconds, safe to record into from several threads"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = Lock()
+
+    def record(self, upstream, nanoseconds):
+        with self.lock:
+            histogram = self.histograms.get(upstream)
+            if histogram is None:
+                histogram = self.histograms[upstream] = LatencyHistogram()
+            histogram.record(nanoseconds)
+
+    def copy_histograms(self):
+        with self.lock:
+            return {name: LatencyHistogram().add(histogram) for name, histogram in self.histograms.items()}
+
+    def add_histograms(self, histograms):
+        with self.lock:
+            for name, histogram in histograms.items():
+                self.histograms.setdefault(name, LatencyHistogram()).add(histogram)
+
+    def summary(self, upstream=None):
+        """p50/p99/p999 of one upstream, or a dict of them by upstream"""
+        with self.lock:
+            if upstream is not None:
+                histogram = self.histograms.get(upstream)
+                return histogram.summary() if histogram is not None else None
+            return {name: histogram.summary() for name, histogram in self.histograms.items()}
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+_default_recorder = LatencyRecorder()
+
+
+def default_recorder():
+    """The LatencyRecorder shared by all Communication objects not given one"""
+    return _default_recorder
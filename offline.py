@@ -0,0 +1,89 @@
+"""
+Parses recorded traffic offline, one connection per process.
+
+usage 'python offline.py [--workers=N] directory'
+
+A recording holds each connection as two files with the raw bytes of either direction, NAME.request and
+NAME.response (either may be missing). The files are memory-mapped and fed to the same parsers as used
+live; connections are spread over a pool of processes and the RequestResponse pairs of each connection
+come back in order.
+"""
+
+import functools
+import itertools
+import mmap
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import http_parser
+from communication import RequestResponse
+from parser_utils import feed, intialize_parser
+
+FEED_SIZE = 1024 * 1024
+
+
+def parse_stream(path, get_http_request=http_parser.get_http_request):
+    """All messages in a file holding the raw bytes of one direction of a connection"""
+    if path is None or not os.path.getsize(path):
+        return []
+    parser = intialize_parser(get_http_request, batch=True)
+    messages = []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        with memoryview(data) as view:
+            for start in range(0, len(view), FEED_SIZE):
+                messages += feed(parser, view[start:start + FEED_SIZE])
+        # The end of the file ends a body running to the end of the stream
+        messages += feed(parser, b"")
+    return messages
+
+
+def parse_connection(connection, get_http_request=http_parser.get_http_request):
+    """The RequestResponse pairs of a (name, request path, response path) connection"""
+    name, request_path, response_path = connection
+    requests = parse_stream(request_path, get_http_request)
+    responses = parse_stream(response_path, get_http_request)
+    return name, [RequestResponse(request, response) for request, response in itertools.zip_longest(requests, responses)]
+
+
+def find_connections(directory):
+    """(name, request path, response path) for every connection recorded in the directory, by name"""
+    paths = {}
+    for filename in os.listdir(directory):
+        name, extension = os.path.splitext(filename)
+        if extension in (".request", ".response"):
+            paths.setdefault(name, {})[extension] = os.path.join(directory, filename)
+    return [(name, paths[name].get(".request"), paths[name].get(".response")) for name in sorted(paths)]
+
+
+def parse_connections(connections, workers=None, get_http_request=http_parser.get_http_request):
+    """
+    Parse the connections in a pool of worker processes, the number of CPUs by default.
+
+    Yields (name, pairs) for each connection as soon as it and all before it have been parsed,
+    in the order given.
+    """
+    parse = functools.partial(parse_connection, get_http_request=get_http_request)
+    if workers == 1:
+        yield from map(parse, connections)
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        yield from executor.map(parse, connections)
+
+
+def parse_command_line(argv):
+    workers = None
+    for arg in [arg for arg in argv if arg.startswith('--workers=')]:
+        workers = int(arg.split('=', 1)[1])
+        argv = [other for other in argv if other != arg]
+    if len(argv) != 2:
+        raise SystemExit(__doc__)
+    return argv[1], workers
+
+
+if __name__ == '__main__':
+    directory, workers = parse_command_line(sys.argv)
+    for name, pairs in parse_connections(find_connections(directory), workers):
+        print("Connection %s, %d exchanges" % (name, len(pairs)))
+        for pair in pairs:
+            print(pair)
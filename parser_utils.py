@@ -1,5 +1,206 @@
+import mmap
+import re
+import tempfile
+import time
+
 SPACES = [ord(x) for x in " \t\r\n"]
 
+_WORD = re.compile(b"[^%s]*" % re.escape(bytes(SPACES)))
+_SPACE_RUN = re.compile(b"[%s]*" % re.escape(bytes(SPACES)))
+
+
+class Buffer:
+    """
+    Receive buffer shared by the parser combinators.
+
+    Chunks are appended in place and a read cursor marks how much has been consumed, so taking
+    a value off the front never copies the unread tail. Bytes-like input is kept in a bytearray;
+    str input (used by the simple text parsers) is kept as str, the chunks received being joined to it
+    only once they are looked into, so that waiting for a long value does not copy it over and over.
+
+    With zero_copy set, parsers hand out values such as message bodies as memoryview slices over
+    the buffer. The storage they point into is then left alone, and new data goes to a fresh one.
+
+    Positions in the whole stream are available through position; setting retain_from keeps the
+    data from that position on, even once consumed, so that it can be read back with raw().
+
+    In batch mode, batch collects the results completed since the parser last suspended.
+
+    Parsers that support them read their limits, such as http_parser.HttpLimits, from limits.
+    """
+
+    stats = None
+    limits = None
+
+    def __init__(self, data=None, zero_copy=False, batch=False):
+        self._data = None
+        # str chunks not joined to _data yet, and their total length
+        self._pending = []
+        self._pending_size = 0
+        self._pos = 0
+        self._base = 0
+        self._pinned = False
+        self.zero_copy = zero_copy
+        self.retain_from = None
+        self.batch = [] if batch else None
+        self.extend(data)
+
+    def __len__(self):
+        if self._data is None:
+            return 0
+        return len(self._data) - self._pos + self._pending_size
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __getitem__(self, index):
+        if self._pending:
+            self._join()
+        return self._data[self._pos + index]
+
+    @property
+    def position(self):
+        """Number of items consumed since the start of the stream"""
+        return self._base + self._pos
+
+    def extend(self, moredata):
+        if not moredata:
+            return
+        if self._data is None:
+            self._data = moredata if isinstance(moredata, str) else bytearray(moredata)
+            return
+
+        if isinstance(self._data, str):
+            self._pending.append(moredata)
+            self._pending_size += len(moredata)
+            return
+
+        keep = self._keep()
+        if self._pinned:
+            with memoryview(self._data) as view:
+                self._data = bytearray(view[keep:])
+            self._data += moredata
+            self._pinned = False
+        else:
+            # Drop the consumed prefix only once it outweighs the unread tail,
+            # so every byte is moved a bounded number of times.
+            if not keep or keep < len(self._data) - keep:
+                keep = 0
+            del self._data[:keep]
+            self._data += moredata
+        self._base += keep
+        self._pos -= keep
+
+    def _keep(self):
+        """How much of the data at the front may be dropped"""
+        if self.retain_from is None:
+            return self._pos
+        return max(min(self._pos, self.retain_from - self._base), 0)
+
+    def _join(self):
+        keep = self._keep()
+        self._data = "".join([self._data[keep:]] + self._pending)
+        self._pending = []
+        self._pending_size = 0
+        self._base += keep
+        self._pos -= keep
+
+    def raw(self, start, end):
+        """Return the data between two stream positions, which must not have been dropped yet, as a memoryview"""
+        if self._data is None:
+            return memoryview(b"")
+        if self._pending:
+            self._join()
+        self._pinned = True
+        return memoryview(self._data)[start - self._base:end - self._base]
+
+    def find(self, sub, start=0):
+        if self._data is None:
+            return -1
+        if self._pending:
+            self._join()
+        index = self._data.find(sub, self._pos + start)
+        return index - self._pos if index >= 0 else -1
+
+    def match_end(self, pattern, start=0, end=None):
+        """Return the offset where a match of the pattern starting at start ends"""
+        if self._data is None:
+            return 0
+        if self._pending:
+            self._join()
+        end = len(self._data) if end is None else self._pos + end
+        return pattern.match(self._data, self._pos + start, end).end() - self._pos
+
+    def take(self, count, view=False):
+        """Consume count items, as a memoryview over the buffer if view is set and the data are bytes"""
+        if self._data is None:
+            return b""
+        if self._pending:
+            self._join()
+        start = self._pos
+        self._pos = min(start + count, len(self._data))
+        if isinstance(self._data, str):
+            return self._data[start:self._pos]
+        if view:
+            self._pinned = True
+            return memoryview(self._data)[start:self._pos]
+        with memoryview(self._data) as data:
+            return bytes(data[start:self._pos])
+
+    def take_all(self, view=False):
+        return self.take(len(self), view)
+
+    def skip(self, count):
+        if self._pending:
+            self._join()
+        if self._data is not None:
+            self._pos = min(self._pos + count, len(self._data))
+
+    def take_batch(self):
+        """Return the results collected in batch mode and start a new batch, or None outside batch mode"""
+        batch = self.batch
+        if batch is not None:
+            self.batch = []
+        return batch
+
+
+class LimitExceeded(ValueError):
+    """The data go beyond a limit of the parser, such as a line longer than allowed"""
+
+
+class SpooledBytes:
+    """
+    Bytes collected in memory up to max_in_memory (None for no bound) and in a temporary file beyond.
+
+    getvalue() returns the bytes collected, memory-mapped if they went to the file.
+    """
+
+    def __init__(self, max_in_memory=None):
+        self.max_in_memory = max_in_memory
+        self.parts = []
+        self.file = None
+        self.size = 0
+
+    def write(self, data):
+        if self.file is None and self.max_in_memory is not None and self.size + len(data) > self.max_in_memory:
+            self.file = tempfile.TemporaryFile()
+            self.file.writelines(self.parts)
+            self.parts = None
+        if self.file is not None:
+            self.file.write(data)
+        else:
+            self.parts.append(data if isinstance(data, bytes) else bytes(data))
+        self.size += len(data)
+
+    def getvalue(self):
+        if self.file is None:
+            return b"".join(self.parts)
+        self.file.flush()
+        # The mapping keeps the data once the file is closed, and deleted
+        value = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self.file.close()
+        return value
+
 
 def parse(parser, data):
     result = parser.send(data)
@@ -11,72 +212,219 @@ def parse(parser, data):
         result = next(parser)
 
 
+class ParserStats:
+    """Counters of where a parser spends its work, kept by an InstrumentedBuffer"""
+    __slots__ = ("bytes_consumed", "resumptions", "bytes_copied", "rescans", "messages", "seconds")
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def add(self, other):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+    def snapshot(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class InstrumentedBuffer(Buffer):
+    """
+    Buffer counting the data going through it in stats.
+
+    Only parsers given an InstrumentedBuffer pay for the counting, a plain Buffer is left as it is.
+    The time spent parsing is added by the code driving the parser, see timed_feed.
+    """
+
+    def __init__(self, data=None, zero_copy=False, batch=False):
+        self.stats = ParserStats()
+        Buffer.__init__(self, data, zero_copy, batch)
+
+    def extend(self, moredata):
+        stats = self.stats
+        stats.resumptions += 1
+        if not moredata:
+            return
+        size = 0 if self._data is None else len(self._data)
+        base = self._base
+        moves_all = self._pinned
+        Buffer.extend(self, moredata)
+        dropped = self._base - base
+        stats.bytes_copied += len(moredata)
+        if moves_all or dropped:
+            stats.bytes_copied += size - dropped
+
+    def _join(self):
+        # The unread str data move along with the chunks joined to them
+        self.stats.bytes_copied += len(self._data) - self._keep()
+        Buffer._join(self)
+
+    def take(self, count, view=False):
+        value = Buffer.take(self, count, view)
+        self.stats.bytes_consumed += len(value)
+        if not view or isinstance(value, str):
+            self.stats.bytes_copied += len(value)
+        return value
+
+    def skip(self, count):
+        before = len(self)
+        Buffer.skip(self, count)
+        self.stats.bytes_consumed += before - len(self)
+
+
+def feed(parser, data):
+    """
+    Batch alternative to parse, for parsers initialized with batch set.
+
+    Returns the list of all results completed with the data, which takes a single resumption of
+    the parser. Unlike with parse, a body running to the end of the stream ends only with an empty feed.
+    """
+    return parser.send(data)
+
+
+def timed_feed(parser, data, stats):
+    """feed, adding the time spent in the parser to stats"""
+    start = time.perf_counter()
+    results = parser.send(data)
+    stats.seconds += time.perf_counter() - start
+    return results
+
+
 def get_main_loop(parser_func):
-    def main_loop():
-        data = yield None
+    def main_loop(data):
+        data.extend((yield None))
         while True:
             result, data = yield from parser_func(data)
-            data = yield from get_more(data, result)
+            if data.stats is not None:
+                data.stats.messages += 1
+            if data.batch is not None:
+                data.batch.append(result)
+            else:
+                data = yield from get_more(data, result)
 
     return main_loop
 
 
-def intialize_parser(parser_func):
-    parser = get_main_loop(parser_func)()
+def intialize_parser(parser_func, data=None, batch=False):
+    if data is None:
+        data = Buffer()
+    if batch:
+        data.batch = []
+    parser = get_main_loop(parser_func)(data)
     next(parser)
     return parser
 
 
-def get_word(data: str):
-    while not data:
+def get_word(data, limit=None):
+    """The next word and the whitespace after it, which together must not go beyond limit items"""
+    lindex = data.match_end(_WORD)
+    while len(data) <= lindex:
+        check_limit(len(data), limit)
         data = yield from get_more(data)
+        lindex = data.match_end(_WORD, lindex)
 
-    lindex = 0
-    while data[lindex] not in SPACES:
-        lindex += 1
-        while len(data) <= lindex:
-            data = yield from get_more(data)
+    rindex = data.match_end(_SPACE_RUN, lindex)
+    while len(data) <= rindex:
+        check_limit(len(data), limit)
+        data = yield from get_more(data)
+        rindex = data.match_end(_SPACE_RUN, rindex)
+    check_limit(rindex, limit)
 
-    rindex = lindex
-    while data[rindex] in SPACES:
-        rindex += 1
-        while len(data) <= rindex:
-            data = yield from get_more(data)
+    word = data.take(lindex)
+    data.skip(rindex - lindex)
+    return word, data
 
-    return data[:lindex], data[rindex:]
 
+def check_limit(size, limit):
+    if limit is not None and size > limit:
+        raise LimitExceeded("More than %d bytes" % limit)
 
-def get_until(data, delimiter):
-    index = -1
+
+def find_delimiter(data, delimiter, start=0, limit=None):
+    """The index of the delimiter, which must be found within limit items"""
+    index = data.find(delimiter, start)
     while index < 0:
-        index = data.find(delimiter)
-        if index < 0:
-            data = yield from get_more(data)
+        check_limit(len(data), limit)
+        # Everything before the last len(delimiter) - 1 items has been scanned already
+        start = max(len(data) - len(delimiter) + 1, start)
+        if data.stats is not None:
+            data.stats.rescans += 1
+        data = yield from get_more(data)
+        index = data.find(delimiter, start)
+    check_limit(index, limit)
+
+    return index, data
+
+
+def get_until(data, delimiter, limit=None):
+    index, data = yield from find_delimiter(data, delimiter, limit=limit)
+    value = data.take(index)
+    data.skip(len(delimiter))
+    return value, data
 
-    return data[:index], data[index + len(delimiter):]
 
+def get_bytes(data, count, max_in_memory=None):
+    """count items; with more than max_in_memory of them, they are spooled to a file as they arrive"""
+    if max_in_memory is not None and count > max_in_memory:
+        value = SpooledBytes(0)
+        data = yield from spool_bytes(data, count, value)
+        return value.getvalue(), data
 
-def get_bytes(data, count):
     while (len(data) < count):
         data = yield from get_more(data)
 
-    return data[:count], data[count:]
+    return data.take(count, data.zero_copy), data
+
+
+def spool_bytes(data, count, value):
+    """Write the next count bytes to a SpooledBytes as they arrive"""
+    while count > 0:
+        while not data:
+            data = yield from get_more(data)
+        piece = data.take(count)
+        value.write(piece)
+        count -= len(piece)
+
+    return data
+
+
+def skip_bytes(data, count):
+    while count > 0:
+        while not data:
+            data = yield from get_more(data)
+        skipped = min(count, len(data))
+        data.skip(skipped)
+        count -= skipped
+
+    return data
 
 
-def get_rest(data):
-    moredata = yield
-    while moredata:
-        data += moredata
-        moredata = yield
+def get_rest(data, max_in_memory=None):
+    """What arrives until a resumption brings no data; beyond max_in_memory, spooled to a file"""
+    value = None
+    while True:
+        moredata = yield data.take_batch()
+        data.extend(moredata)
+        if value is None and max_in_memory is not None and len(data) > max_in_memory:
+            value = SpooledBytes(0)
+        if value is not None:
+            value.write(data.take_all())
+        if not moredata:
+            break
 
-    return data, ""
+    if value is None:
+        return data.take_all(data.zero_copy), data
+    return value.getvalue(), data
 
 
 def get_more(data, result=None):
+    if data.batch is not None:
+        if result is not None:
+            # The result is collected and parsing goes on without suspending
+            data.batch.append(result)
+            return data
+        result = data.take_batch()
     moredata = yield result
-    if data and moredata:
-        return data + moredata
-    elif moredata:
-        return moredata
-    else:
-        return data
+    data.extend(moredata)
+    return data
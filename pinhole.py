@@ -0,0 +1,94 @@
+"""
+usage 'pinhole [--stream] [--zero-copy] [--raw] [--recv-size=bytes] [--pool] [--stats] [--latency-file=path]
+               [--capture-file=path] [--capture-body-limit=bytes] [--high-water=bytes] [--low-water=bytes]
+               [--max-line=bytes] [--max-headers=bytes] [--max-body-in-memory=bytes] [--backlog=n] [--workers=n]
+               port host [newport]'
+
+Pinhole forwards the port to the host specified.
+The optional newport parameter may be used to
+redirect to a different port.
+
+eg. pinhole 80 webserver
+    Forward all incoming WWW sessions to webserver.
+
+    pinhole 23 localhost 2323
+    Forward all telnet sessions to port 2323 on localhost.
+
+Chunked message bodies are forwarded chunk by chunk as they arrive, with
+their trailers. With --stream, all message bodies are forwarded as they
+arrive instead of being buffered until the message is complete.
+
+Of a body forwarded as it arrives, only the first --capture-body-limit bytes
+(64 KB by default, 0 for none) are kept for the captured exchange.
+With --capture-body-limit=0, the part of a Content-Length body not received
+yet with the head is moved from one socket to the other by the kernel, with
+os.splice on Linux, without being read into the proxy.
+
+With --zero-copy, message bodies and header values are kept as memoryview
+slices over the receive buffer and passed to the socket without copying.
+
+With --raw, the received bytes are forwarded unchanged as soon as they
+are framed, only the Host header of requests being rewritten.
+
+--recv-size sets how much is read from a socket at once (64 KB by default).
+
+--high-water and --low-water (1 MB and 256 KB by default) bound the bytes
+of a connection received but not forwarded yet. A body longer than the high
+mark is forwarded as it arrives instead of being buffered, and so is a body
+running to the end of the connection. Once the bytes held pass the high mark,
+the connection is throttled: the asyncio Pinhole stops reading from it until
+they fall below the low mark. The threaded one writes synchronously, so it
+never reads ahead of a slow peer.
+
+--max-line and --max-headers (8 KB and 64 KB by default) limit the length
+of a line, such as the request line, and of the header block. A request
+going beyond them is answered with 431 Request Header Fields Too Large and
+its connection closed as soon as that is known. A body kept whole and longer
+than --max-body-in-memory (1 MB by default) is spooled to a temporary file.
+
+With --pool, upstream connections are kept alive between client
+connections and reused, one request/response exchange at a time.
+
+With --stats, the parsers count the bytes, copies and resumptions they go
+through and the time they take; the totals over all connections are printed
+on exit.
+
+--latency-file names a file to which the p50/p99/p999 upstream latencies
+are written on exit.
+
+--capture-file appends the captured exchanges to an indexed binary capture
+file (see capture_file.py) instead of printing them.
+
+--backlog sets the length of the queue of connections waiting to be accepted.
+
+With --workers, that many worker processes each accept connections on the
+port, shared through SO_REUSEPORT, and parse them independently. A supervisor
+process writes their captures, merges their metrics and restarts the workers
+that die (see supervisor.py).
+"""
+
+import sys
+
+import supervisor
+from command_line import parse_command_line, setup_outputs
+from pipe import Pinhole
+from upstream_pool import UpstreamPool
+
+
+def main(argv):
+    port, newhost, newport, options = parse_command_line(argv)
+    if 'workers' in options:
+        supervisor.main(port, newhost, newport, options)
+        return
+    if options.pop('pool', False):
+        options['pool'] = UpstreamPool()
+    setup_outputs(options)
+    Pinhole(port, newhost, newport, **options).start()
+
+
+if __name__ == '__main__':
+    print('Starting Pinhole')
+
+    # sys.stdout = open('pinhole.log', 'w')
+
+    main(sys.argv)
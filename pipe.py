@@ -1,31 +1,46 @@
 """
 Code adapted from here: http://code.activestate.com/recipes/114642-pinhole/, licensed under Python Software Foundation License
 
-usage 'pinhole port host [newport]'
-
-Pinhole forwards the port to the host specified.
-The optional newport parameter may be used to
-redirect to a different port.
-
-eg. pinhole 80 webserver
-    Forward all incoming WWW sessions to webserver.
-
-    pinhole 23 localhost 2323
-    Forward all telnet sessions to port 2323 on localhost.
+Pinhole and the pipes forwarding the HTTP messages of its connections; started by pinhole.py, which
+describes the options.
 """
 
-import uuid
+import os
+import sys
+import copy
+import functools
 from socket import *
-from threading import Thread
+from threading import Event, Lock, Thread
 import time
 
-import collections
-
 import http_parser
-from parser_utils import intialize_parser, parse
+from communication import Communication, MessageTiming
+from parser_utils import Buffer, InstrumentedBuffer, ParserStats, feed, intialize_parser, parse, timed_feed
 
 LOGGING = 0
 
+RECV_SIZE = 65536
+
+BACKLOG = 128
+
+CAPTURE_BODY_LIMIT = 65536
+
+HIGH_WATER = 1024 * 1024
+LOW_WATER = 256 * 1024
+
+MAX_LINE = 8192
+MAX_HEADERS = 65536
+MAX_BODY_IN_MEMORY = 1024 * 1024
+
+HEADERS_TOO_LARGE = b"HTTP/1.1 431 Request Header Fields Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+SPLICE = hasattr(os, 'splice')
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
 
 def log(s):
     if LOGGING:
@@ -33,162 +48,588 @@ def log(s):
         sys.stdout.flush()
 
 
-class RequestResponse:
-    def __init__(self, request=None, response=None):
-        self.guid = uuid.uuid4()
-        self.response = response
-        self.request = request
-
-    def __str__(self):
-        s = "====================================================\n"
-        s += "Communication " + str(self.guid) + "\n"
-        s += "REQUEST:\n"
-        s += str(self.request) + "\n"
-        s += "RESPONSE:\n"
-        s += str(self.response) + "\n"
-        s += "====================================================\n"
-        return s
-
-
-class Communication:
-    def __init__(self):
-        self.pending_requests = collections.deque()
-        self.pending_responses = collections.deque()
-
-    def add_message(self, message, tag):
-        if tag == "request":
-            self.add_request(message)
-        elif tag == "response":
-            self.add_response(message)
+class FlowControl:
+    """
+    High and low water marks on the bytes a connection has received but not forwarded yet.
+
+    The connection is throttled from when they pass high_water until they fall below low_water.
+    How many connections are throttled, now and in all, is counted over all of them.
+    """
+    lock = Lock()
+    throttled_now = 0
+    throttled_total = 0
+
+    def __init__(self, high_water=HIGH_WATER, low_water=LOW_WATER):
+        if not 0 <= low_water <= high_water:
+            raise ValueError("low_water must be between 0 and high_water, not %r" % low_water)
+        self.high_water = high_water
+        self.low_water = low_water
+        self.throttled = False
+
+    def update(self, held):
+        """Whether the connection is throttled with held bytes not forwarded"""
+        if not self.throttled and held > self.high_water:
+            self.set_throttled(True)
+        elif self.throttled and held < self.low_water:
+            self.set_throttled(False)
+        return self.throttled
+
+    def set_throttled(self, throttled):
+        self.throttled = throttled
+        with FlowControl.lock:
+            FlowControl.throttled_now += 1 if throttled else -1
+            FlowControl.throttled_total += throttled
+
+    def close(self):
+        if self.throttled:
+            self.set_throttled(False)
+
+    @staticmethod
+    def counts():
+        with FlowControl.lock:
+            return {"throttled": FlowControl.throttled_now, "throttled_total": FlowControl.throttled_total}
+
+
+class Pipe:
+    """
+    Forwards the HTTP messages of one direction of a connection, independent of how the bytes are read and written.
+    Subclasses provide send(). Those reading the source themselves can set splices and provide
+    splice_body(count), which forwards the next count bytes of the source without parsing them.
+    """
+
+    # Whether bodies not captured are left to splice_body rather than read through the parser
+    splices = False
+
+    def __init__(self, tag, communication, newhost, newport, streaming=False, zero_copy=False, raw=False,
+                 recv_size=RECV_SIZE, instrumented=False, capture_body_limit=CAPTURE_BODY_LIMIT,
+                 high_water=HIGH_WATER, low_water=LOW_WATER, max_line=MAX_LINE, max_headers=MAX_HEADERS,
+                 max_body_in_memory=MAX_BODY_IN_MEMORY):
+        self.communication = communication
+        self.tag = tag
+        self.streaming = streaming
+        self.zero_copy = zero_copy
+        self.raw = raw
+        self.recv_size = recv_size
+        self.instrumented = instrumented
+        self.capture_body_limit = capture_body_limit
+        self.flow = FlowControl(high_water, low_water)
+        self.limits = http_parser.HttpLimits(max_line, max_headers, max_body_in_memory)
+        self.buffer = None
+        # The start of the body being streamed, kept for the captured message
+        self.captured_body = []
+        self.captured_size = 0
+        self.upstream_name = "%s:%s" % (newhost, newport)
+        # When the current message started arriving and when data was last received
+        self.first_byte_ns = None
+        self.received_ns = None
+        self.newhost = newhost
+        self.newport = newport
+        self.messages = 0
+        self.last_message = None
+        # Of a request pipe, the pipe writing to its client, which also answers a request that is too large
+        self.response_pipe = None
+        # Whether the client is to be told its request is too large once this pipe stops
+        self.reject_pending = False
+        # Of a pipe reading the responses to a single request, the method of that request
+        self.request_method = None
+
+        if newport != 80:
+            self.host_header = b"%s:%s" % (str(newhost).encode(), str(newport).encode())
         else:
-            raise Exception("Unknown tag " + tag)
+            self.host_header = b"%s" % (str(newhost).encode())
+
+    def send(self, data):
+        pass
+
+    def send_buffers(self, buffers):
+        for data in buffers:
+            self.send(data)
 
-    def add_request(self, request):
-        if self.pending_responses:
-            request_response = self.pending_responses.popleft()
-            request_response.request = request
-            self.have_request_response(request_response)
+    def send_request(self, msg):
+        self.send_buffers(msg.to_buffers())
+
+    def create_parser(self):
+        # In batch mode a feed hands back every message it completed at once
+        buffer_class = InstrumentedBuffer if self.instrumented else Buffer
+        self.buffer = buffer_class(zero_copy=self.zero_copy, batch=True)
+        self.buffer.limits = self.limits
+        splice = self.splices and self.capture_body_limit == 0
+        if self.raw:
+            # Received bytes are kept in the buffer until they have been forwarded
+            self.buffer.retain_from = self.forwarded = 0
+            self.in_message = False
+            self.parser = intialize_parser(functools.partial(http_parser.get_http_frames,
+                                                             request_method=self.request_method), self.buffer)
+            self.handle = self.handle_frame
+        elif self.streaming:
+            self.parser = intialize_parser(functools.partial(http_parser.get_http_events, splice=splice,
+                                                             request_method=self.request_method), self.buffer)
+            self.handle = self.handle_event
+        else:
+            self.parser = intialize_parser(functools.partial(http_parser.get_http_messages, splice=splice,
+                                                             stream_above=self.flow.high_water,
+                                                             request_method=self.request_method), self.buffer)
+            self.handle = self.handle_message_or_event
+
+    def feed(self, data):
+        if data:
+            self.received_ns = time.monotonic_ns()
+            self.message_started()
+        if self.instrumented:
+            messages = timed_feed(self.parser, data, self.buffer.stats)
+        else:
+            messages = feed(self.parser, data)
+        for msg in messages:
+            self.handle(msg)
+        if self.raw and self.in_message:
+            self.forward_raw(self.buffer.position)
+        # Data left in the buffer is the start of the next message
+        if self.buffer:
+            self.message_started()
+        throttled = self.flow.throttled
+        if self.flow.update(self.held()) and not throttled:
+            log('%s throttled with %s bytes held' % (self, self.held()))
+
+    def held(self):
+        """Bytes received but not forwarded yet, in the parser or waiting to be sent"""
+        return (len(self.buffer) if self.buffer is not None else 0) + self.send_backlog()
+
+    def send_backlog(self):
+        """Bytes given to send() but not written out yet"""
+        return 0
+
+    def between_messages(self):
+        """Whether no message has been partly forwarded"""
+        return self.first_byte_ns is None and not self.buffer
+
+    def message_started(self):
+        if self.first_byte_ns is None:
+            self.first_byte_ns = self.received_ns
+
+    def message_forwarded(self, msg):
+        # A message following another one in the same feed started with the data just received
+        self.message_started()
+        timing = MessageTiming(self.first_byte_ns, time.monotonic_ns(), self.upstream_name)
+        self.communication.add_message(msg, self.tag, timing)
+        self.first_byte_ns = None
+        self.messages += 1
+        self.last_message = msg
+
+    def parser_stats(self):
+        """Snapshot of the parser counters of this connection, None unless instrumented"""
+        if self.buffer is None or self.buffer.stats is None:
+            return None
+        return self.buffer.stats.snapshot()
+
+    def rewrite_host(self, msg):
+        if self.tag == "request" and msg.headers.get(b"Host"):
+            msg.headers[b"Host"] = self.host_header
+
+    def rewrite_headers(self, msg):
+        """Return a copy of the message to forward, leaving the one handed to communication as received"""
+        msg = copy.copy(msg)
+        msg.headers = msg.headers.copy()
+        self.rewrite_host(msg)
+        return msg
+
+    def handle_message(self, msg):
+        # print(msg)
+        self.send_request(self.rewrite_headers(msg))
+        self.message_forwarded(msg)
+
+    def handle_message_or_event(self, item):
+        if isinstance(item, http_parser.HttpMessage):
+            self.handle_message(item)
         else:
-            request_response = RequestResponse(request=request)
-            self.pending_requests.append(request_response)
-            self.have_request_response(request_response)
-
-    def add_response(self, response):
-        if self.pending_requests:
-            request_response = self.pending_requests.popleft()
-            request_response.response = response
-            self.have_request_response(request_response)
+            self.handle_event(item)
+
+    def handle_event(self, event):
+        msg = event.message
+        if isinstance(event, http_parser.HttpHeaders):
+            self.message_started()
+            self.send_buffers(list(self.rewrite_headers(msg).head_to_bytes()))
+        elif isinstance(event, http_parser.HttpBodyFragment):
+            if msg.is_chunked():
+                self.send_buffers([b"%x\r\n" % len(event.data), event.data, b"\r\n"])
+            else:
+                self.send(event.data)
+            self.capture_body(event.data)
+        elif isinstance(event, http_parser.HttpBodySplice):
+            # Only asked for when the pipe splices, see create_parser
+            self.splice_body(event.count)
+            self.received_ns = time.monotonic_ns()
         else:
-            request_response = RequestResponse(response=response)
-            self.pending_responses.append(request_response)
-            self.have_request_response(request_response)
+            if msg.is_chunked():
+                self.send_buffers(list(msg.last_chunk_to_bytes()))
+            if self.captured_body:
+                msg.body = b"".join(self.captured_body)
+                self.captured_body = []
+                self.captured_size = 0
+            self.message_forwarded(msg)
+
+    def capture_body(self, data):
+        if self.captured_size < self.capture_body_limit:
+            data = data[:self.capture_body_limit - self.captured_size]
+            self.captured_body.append(bytes(data))
+            self.captured_size += len(data)
+
+    def handle_frame(self, event):
+        msg = event.message
+        if isinstance(event, http_parser.HttpHeaders):
+            self.message_started()
+            start, end = msg.head_range
+            self.forward_raw(start)
+            host = msg.headers.get(b"Host")
+            if self.tag == "request" and host and host != self.host_header:
+                self.send_rewritten_head(msg)
+            self.in_message = True
+        else:
+            self.forward_raw(msg.body_range[1])
+            self.in_message = False
+            self.message_forwarded(msg)
+
+    def send_rewritten_head(self, msg):
+        field = msg.headers.field_range(b"Host")
+        if field is None:
+            # Left to be forwarded unchanged
+            return
+        # The header block is followed by the empty line ending the head
+        block = msg.head_range[1] - 2 - len(msg.headers.raw)
+        self.send(self.buffer.raw(self.forwarded, block + field[0]))
+        self.send(b"Host: %s" % self.host_header)
+        self.forwarded = block + field[1]
+
+    def forward_raw(self, end):
+        if end > self.forwarded:
+            self.send(self.buffer.raw(self.forwarded, end))
+            self.forwarded = self.buffer.retain_from = end
+
+
+def send_buffers(sock, buffers):
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b"".join(buffers))
+        return
+
+    buffers = [memoryview(data) for data in buffers]
+    first = 0
+    while first < len(buffers):
+        sent = sock.sendmsg(buffers[first:first + IOV_MAX])
+        # Skip what was written, a short write may end in the middle of a buffer
+        while first < len(buffers) and sent >= len(buffers[first]):
+            sent -= len(buffers[first])
+            first += 1
+        if sent:
+            buffers[first] = buffers[first][sent:]
+
+
+def reject(client):
+    """Tell the client its request is too large and close the connection"""
+    try:
+        client.sendall(HEADERS_TOO_LARGE)
+    except OSError:
+        pass
+    shutdown(client, SHUT_RDWR)
+
+
+def shutdown(sock, how):
+    """Shut the socket down, unless its connection is gone already"""
+    try:
+        sock.shutdown(how)
+    except OSError:
+        pass
+
+
+class SocketPipe(Pipe):
+    def __init__(self, sink, tag, communication, newhost, newport, **options):
+        Pipe.__init__(self, tag, communication, newhost, newport, **options)
+        self.sink = sink
+
+    def send(self, data):
+        # print(data)
+        self.sink.sendall(data)
 
-    def have_request_response(self, request_response):
-        print(request_response)
+    def send_buffers(self, buffers):
+        send_buffers(self.sink, buffers)
 
 
-class PipeThread(Thread):
+class PipeThread(SocketPipe, Thread):
+    splices = True
     pipes = []
+    # Parser counters of the pipes that have finished already
+    finished_stats = ParserStats()
+    finished_stats_lock = Lock()
 
-    def __init__(self, source, sink, tag, communication, newhost, newport):
+    def __init__(self, source, sink, tag, communication, newhost, newport, **options):
         Thread.__init__(self)
-        self.communication = communication
-        self.tag = tag
+        SocketPipe.__init__(self, sink, tag, communication, newhost, newport, **options)
         self.source = source
-        self.sink = sink
-
-        if newport != 80:
-            self.host_header = b"%s:%s" % (str(newhost).encode(), str(newport).encode())
-        else:
-            self.host_header = b"%s" % (str(newhost).encode())
+        # The read and write ends of the pipe that splice_body moves data through
+        self.splice_pipe = None
+        # Guards reject_pending against the pipe finishing meanwhile
+        self.lock = Lock()
+        self.finished = False
 
         log('Creating new pipe thread  %s ( %s -> %s )' % \
             (self, source.getpeername(), sink.getpeername()))
         PipeThread.pipes.append(self)
         log('%s pipes active' % len(PipeThread.pipes))
 
-    def send(self, data):
-        # print(data)
-        self.sink.send(data)
-
-    def send_request(self, msg):
-        for data in msg.to_bytes():
-            self.send(data)
-
     def run(self):
-        parser = intialize_parser(http_parser.get_http_request)
+        self.create_parser()
+        # Received data is only valid until the next recv_into, the parser copies what it keeps
+        # Sends block, so a slow sink stops the reading of the source. As bodies longer than high_water are
+        # streamed, no more than high_water + recv_size bytes are held meanwhile.
+        recv_buffer = bytearray(self.recv_size)
+        recv_view = memoryview(recv_buffer)
         while 1:
             try:
                 try:
-                    data = self.source.recv(1024)
+                    data = recv_view[:self.source.recv_into(recv_buffer)]
                 except ConnectionResetError:
-                    data = None
-
-                if self.tag == "request":
-                    for msg in parse(parser, data):
-                        self.communication.add_message(msg, self.tag)
-                        # print(msg)
-                        if msg.headers.get(b"Host"):
-                            msg.headers[b"Host"] = self.host_header
-                        self.send_request(msg)
-                else:
-                    for msg in parse(parser, data):
-                        self.communication.add_message(msg, self.tag)
-                        # print(msg)
-                        if msg.headers.get(b"Transfer-Encoding", "") == b"chunked":
-                            del msg.headers[b"Transfer-Encoding"]
-                            msg.headers[b"Content-Length"] = str(len(msg.body)).encode()
-                        self.send_request(msg)
+                    data = b""
+
+                self.feed(data)
 
                 if not data:
                     break
+            except http_parser.LimitExceeded as ex:
+                log('%s %s' % (self, ex))
+                if self.tag == 'request':
+                    self.reject_request()
+                break
             except Exception as ex:
                 print(ex)
                 break
 
+        if self.splice_pipe is not None:
+            for fd in self.splice_pipe:
+                os.close(fd)
         log('%s terminating' % self)
         PipeThread.pipes.remove(self)
+        PipeThread.pipe_finished(self)
         log('%s pipes active' % len(PipeThread.pipes))
 
-        self.sink.shutdown(socket.SHUT_WR)
+        with self.lock:
+            self.finished = True
+        if self.reject_pending:
+            if self.between_messages():
+                reject(self.sink)
+            else:
+                shutdown(self.sink, SHUT_RDWR)
+        else:
+            shutdown(self.sink, SHUT_WR)
+
+    def reject_request(self):
+        """Have the client told its request is too large, by the response pipe while it is writing to the client"""
+        response = self.response_pipe
+        if response is not None:
+            with response.lock:
+                if not response.finished:
+                    response.reject_pending = True
+                    # Stops the response pipe, whose reads now end
+                    shutdown(self.sink, SHUT_RDWR)
+                    return
+        reject(self.source)
+
+    def splice_body(self, count):
+        """Forward the next count bytes of the source without parsing them"""
+        if not SPLICE:
+            return self.copy_body(count)
+        if self.splice_pipe is None:
+            self.splice_pipe = os.pipe()
+        read_end, write_end = self.splice_pipe
+        source, sink = self.source.fileno(), self.sink.fileno()
+        while count:
+            # At most a pipe's worth at a time, all of it written out before reading more
+            moved = os.splice(source, write_end, min(count, self.recv_size), flags=os.SPLICE_F_MOVE)
+            if not moved:
+                raise ConnectionError("Connection closed in the middle of a body")
+            count -= moved
+            while moved:
+                moved -= os.splice(read_end, sink, moved, flags=os.SPLICE_F_MOVE)
+
+    def copy_body(self, count):
+        """splice_body through user space, where os.splice is not available"""
+        buffer = bytearray(min(count, self.recv_size))
+        with memoryview(buffer) as view:
+            while count:
+                received = self.source.recv_into(buffer, min(count, len(buffer)))
+                if not received:
+                    raise ConnectionError("Connection closed in the middle of a body")
+                self.sink.sendall(view[:received])
+                count -= received
+
+    @staticmethod
+    def pipe_finished(pipe):
+        pipe.flow.close()
+        if pipe.buffer is not None and pipe.buffer.stats is not None:
+            log('%s parser stats %s' % (pipe, pipe.parser_stats()))
+            with PipeThread.finished_stats_lock:
+                PipeThread.finished_stats.add(pipe.buffer.stats)
+
+    @staticmethod
+    def parser_stats_total():
+        """Parser counters summed over the active pipes and the finished ones"""
+        with PipeThread.finished_stats_lock:
+            total = ParserStats().add(PipeThread.finished_stats)
+        for pipe in list(PipeThread.pipes):
+            if pipe.buffer is not None and pipe.buffer.stats is not None:
+                total.add(pipe.buffer.stats)
+        return total.snapshot()
+
+
+class PooledPipeThread(Pipe, Thread):
+    """
+    Forwards the requests of one client connection over upstream connections taken from a pool.
+
+    Exchanges are handled one at a time: once a request has been forwarded, its response is read and
+    forwarded back, and the upstream connection goes back to the pool if both sides keep it alive.
+    """
+
+    def __init__(self, client, pool, communication, newhost, newport, **options):
+        Thread.__init__(self)
+        Pipe.__init__(self, 'request', communication, newhost, newport, **options)
+        self.client = client
+        self.pool = pool
+        self.options = options
+        self.upstream = None
+        self.forwarded_message = None
+        # Whether the client connection ends with the exchange just forwarded
+        self.closing = False
+        PipeThread.pipes.append(self)
+
+    def create_parser(self):
+        Pipe.create_parser(self)
+        self.handle_open = self.handle
+        self.handle = self.handle_unless_closing
+
+    def handle_unless_closing(self, item):
+        # Requests pipelined after the one ending the connection are not answered
+        if not self.closing:
+            self.handle_open(item)
+
+    def rewrite_headers(self, msg):
+        msg = Pipe.rewrite_headers(self, msg)
+        # Whether the client closes its connection has no bearing on the upstream one
+        msg.headers.pop(b"Connection", None)
+        self.forwarded_message = msg
+        return msg
+
+    def send(self, data):
+        self.send_buffers([data])
+
+    def send_buffers(self, buffers):
+        if self.upstream is None:
+            self.upstream = self.pool.acquire(self.newhost, self.newport)
+        send_buffers(self.upstream.sock, buffers)
+
+    def message_forwarded(self, msg):
+        Pipe.message_forwarded(self, msg)
+        upstream, self.upstream = self.upstream, None
+        request, self.forwarded_message = self.forwarded_message or msg, None
+        responses = SocketPipe(self.client, 'response', self.communication, self.newhost, self.newport,
+                               **self.options)
+        responses.request_method = request.method
+        responses.create_parser()
+        try:
+            # Interim 1xx responses are forwarded as they come, the exchange ends with the final one
+            while responses.last_message is None or responses.last_message.is_interim():
+                try:
+                    data = upstream.sock.recv(self.recv_size)
+                except ConnectionResetError:
+                    data = b""
+                responses.feed(data)
+                if not data:
+                    break
+        except http_parser.LimitExceeded as ex:
+            self.pool.release(upstream, reusable=False)
+            # Not the client's doing, which is only told by its connection being closed
+            raise ConnectionError("Upstream response: %s" % ex)
+        except Exception:
+            self.pool.release(upstream, reusable=False)
+            raise
+
+        PipeThread.pipe_finished(responses)
+        response = responses.last_message
+        if response is None or response.is_interim():
+            self.pool.release(upstream, reusable=False)
+            raise ConnectionError("Upstream closed the connection without a response")
+        reusable = not responses.buffer and response.is_framed() and request.is_persistent() \
+                   and response.is_persistent()
+        self.pool.release(upstream, reusable)
+        if not (response.is_framed() and msg.is_persistent() and response.is_persistent()):
+            # The client learns that the response has ended, or that it gets no more, by the connection closing
+            shutdown(self.client, SHUT_WR)
+            self.closing = True
+
+    def run(self):
+        self.create_parser()
+        while 1:
+            try:
+                try:
+                    data = self.client.recv(self.recv_size)
+                except ConnectionResetError:
+                    data = b""
+
+                self.feed(data)
+
+                if not data or self.closing:
+                    break
+            except http_parser.LimitExceeded as ex:
+                log('%s %s' % (self, ex))
+                reject(self.client)
+                break
+            except Exception as ex:
+                print(ex)
+                break
+
+        if self.upstream is not None:
+            self.pool.release(self.upstream, reusable=False)
+        PipeThread.pipes.remove(self)
+        PipeThread.pipe_finished(self)
+        self.client.close()
 
 
 class Pinhole(Thread):
-    def __init__(self, port, newhost, newport, communication_class=Communication):
+    def __init__(self, port, newhost, newport, communication_class=Communication, pool=None, backlog=BACKLOG,
+                 reuse_port=False, **pipe_options):
         Thread.__init__(self)
         log('Redirecting: localhost:%s -> %s:%s' % (port, newhost, newport))
+        self.port = port
         self.newhost = newhost
         self.newport = newport
         self.communication_class = communication_class
+        self.pool = pool
+        self.backlog = backlog
+        # Lets several processes listen on the port, the kernel spreading connections among them
+        self.reuse_port = reuse_port
+        self.pipe_options = pipe_options
 
     def run(self):
+        stopped = Event()
+        if self.pool is not None:
+            # Idle connections are closed once they time out, not only when next checked out
+            Thread(target=self.pool.evict_idle_until, args=(stopped,), daemon=True).start()
         try:
             self.sock = socket(AF_INET, SOCK_STREAM)
-            self.sock.bind(('', port))
-            self.sock.listen(5)
+            if self.reuse_port:
+                self.sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+            self.sock.bind(('', self.port))
+            self.sock.listen(self.backlog)
             while 1:
                 newsock, address = self.sock.accept()
-                log('Creating new session for %s' % address)
+                log('Creating new session for %s' % (address,))
+                comm = self.communication_class()
+                if self.pool is not None:
+                    PooledPipeThread(newsock, self.pool, comm, self.newhost, self.newport, **self.pipe_options).start()
+                    continue
                 fwd = socket(AF_INET, SOCK_STREAM)
                 fwd.connect((self.newhost, self.newport))
-                comm = self.communication_class()
-                PipeThread(newsock, fwd, 'request', comm, newhost, newport).start()
-                PipeThread(fwd, newsock, 'response', comm, newhost, newport).start()
+                request = PipeThread(newsock, fwd, 'request', comm, self.newhost, self.newport, **self.pipe_options)
+                request.response_pipe = PipeThread(fwd, newsock, 'response', comm, self.newhost, self.newport,
+                                                   **self.pipe_options)
+                request.start()
+                request.response_pipe.start()
         finally:
+            stopped.set()
             self.sock.close()
-
-
-if __name__ == '__main__':
-    print('Starting Pinhole')
-
-    import sys
-
-    # sys.stdout = open('pinhole.log', 'w')
-
-    if len(sys.argv) > 1:
-        port = newport = int(sys.argv[1])
-        newhost = sys.argv[2]
-        if len(sys.argv) == 4: newport = int(sys.argv[3])
-        Pinhole(port, newhost, newport).start()
-    else:
-        Pinhole(8003, 'www.example.com', 80).start()
@@ -0,0 +1,214 @@
+"""
+Runs Pinhole in several worker processes, to use more than one core.
+
+Each worker binds the port with SO_REUSEPORT, so that the kernel spreads incoming connections among them,
+and accepts and parses its connections on its own. Workers hand their captured exchanges and, every
+report_interval seconds, their metrics to the supervisor, each over a pipe of its own so that a worker
+dying in the middle of a write does not affect the others. The supervisor writes the captures
+through its single sink, merges the metrics and starts a new worker in place of any that dies.
+
+Started by 'pinhole --workers=N ...', see pinhole.py.
+"""
+
+import atexit
+import copy
+import functools
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import time
+from threading import Lock, Thread
+
+import capture
+import capture_file
+import latency
+from command_line import print_parser_stats
+from communication import Communication
+from pipe import FlowControl, Pinhole, PipeThread, log
+from upstream_pool import UpstreamPool
+
+REPORT_INTERVAL = 1.0
+
+# Workers are not forked from the supervisor, whose threads may hold locks, such as that of stdout, at that time
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+class Reports:
+    """The sending end of the pipe from a worker to the supervisor, shared by the threads of the worker"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = Lock()
+
+    def put(self, report):
+        with self.lock:
+            self.connection.send(report)
+
+
+class WorkerCaptureSink(capture.CaptureSink):
+    """Hands the captured pairs of a worker to the supervisor"""
+
+    def __init__(self, reports, **options):
+        self.reports = reports
+        super().__init__(**options)
+
+    def write(self, request_response):
+        request_response = copy.copy(request_response)
+        if request_response.request is not None:
+            request_response.request = request_response.request.detached()
+        if request_response.response is not None:
+            request_response.response = request_response.response.detached()
+        self.reports.put(("capture", request_response))
+
+
+def worker_metrics(sink, latencies):
+    return {"parser_stats": PipeThread.parser_stats_total(),
+            "flow": FlowControl.counts(),
+            "latency": latencies.copy_histograms(),
+            "capture_dropped": sink.dropped}
+
+
+def report_metrics(reports, sink, latencies, report_interval):
+    while True:
+        time.sleep(report_interval)
+        reports.put(("metrics", os.getpid(), worker_metrics(sink, latencies)))
+
+
+def run_worker(port, newhost, newport, connection, report_interval, options):
+    reports = Reports(connection)
+    sink = WorkerCaptureSink(reports)
+    latencies = latency.LatencyRecorder()
+    if options.pop('pool', False):
+        options['pool'] = UpstreamPool()
+    Thread(target=report_metrics, args=(reports, sink, latencies, report_interval), daemon=True).start()
+    communication_class = functools.partial(Communication, sink=sink, latencies=latencies)
+    Pinhole(port, newhost, newport, communication_class=communication_class, reuse_port=True, **options).run()
+
+
+class Supervisor:
+    def __init__(self, workers, port, newhost, newport, sink=None, report_interval=REPORT_INTERVAL,
+                 **pinhole_options):
+        self.workers = workers
+        self.port = port
+        self.newhost = newhost
+        self.newport = newport
+        self.sink = sink or capture.default_sink()
+        self.report_interval = report_interval
+        self.pinhole_options = pinhole_options
+        self.processes = []
+        # The receiving ends of the pipes from the workers
+        self.connections = []
+        self.restarts = 0
+        # The last metrics reported by each worker, by pid; those of dead workers are their final totals
+        self.worker_metrics = {}
+        self.metrics_lock = Lock()
+        self.context = multiprocessing.get_context(START_METHOD)
+        self.collector = None
+        self.running = False
+
+    def start_worker(self):
+        reader, writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=run_worker, daemon=True,
+                                       args=(self.port, self.newhost, self.newport, writer,
+                                             self.report_interval, dict(self.pinhole_options)))
+        process.start()
+        writer.close()
+        self.connections.append(reader)
+        log('Started worker %s' % process.pid)
+        return process
+
+    def start(self):
+        self.running = True
+        self.processes = [self.start_worker() for _ in range(self.workers)]
+        self.collector = Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def collect(self):
+        # Runs until every worker has gone once stopped; the timeout picks up the pipes of restarted workers
+        while self.running or self.connections:
+            for connection in multiprocessing.connection.wait(list(self.connections), 0.2):
+                try:
+                    report = connection.recv()
+                except (EOFError, OSError):
+                    self.connections.remove(connection)
+                    connection.close()
+                    continue
+                if report[0] == "capture":
+                    self.sink.put(report[1])
+                else:
+                    _, pid, metrics = report
+                    with self.metrics_lock:
+                        self.worker_metrics[pid] = metrics
+
+    def check_workers(self):
+        """Replace the workers that have died"""
+        for index, process in enumerate(self.processes):
+            if process.exitcode is not None:
+                log('Worker %s exited with %s, restarting it' % (process.pid, process.exitcode))
+                self.processes[index] = self.start_worker()
+                self.restarts += 1
+
+    def run(self, check_interval=0.5):
+        self.start()
+        try:
+            while self.running:
+                time.sleep(check_interval)
+                self.check_workers()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.running = False
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        if self.collector is not None:
+            self.collector.join()
+            self.collector = None
+
+    def latencies(self):
+        """The latency histograms of all workers merged into one LatencyRecorder"""
+        recorder = latency.LatencyRecorder()
+        with self.metrics_lock:
+            for metrics in self.worker_metrics.values():
+                recorder.add_histograms(metrics["latency"])
+        return recorder
+
+    def metrics(self):
+        """Parser counters, throttled connections, capture drops and latencies summed over all workers"""
+        with self.metrics_lock:
+            reports = dict(self.worker_metrics)
+        live = {process.pid for process in self.processes if process.is_alive()}
+        parser_stats = {}
+        # Connections of dead workers are no longer throttled
+        flow = {"throttled": sum(reports[pid]["flow"]["throttled"] for pid in live if pid in reports),
+                "throttled_total": sum(metrics["flow"]["throttled_total"] for metrics in reports.values())}
+        for metrics in reports.values():
+            for name, value in metrics["parser_stats"].items():
+                parser_stats[name] = parser_stats.get(name, 0) + value
+        return {"workers": sum(process.is_alive() for process in self.processes),
+                "restarts": self.restarts,
+                "parser_stats": parser_stats,
+                "flow": flow,
+                "capture_dropped": sum(metrics["capture_dropped"] for metrics in reports.values()),
+                "latency": self.latencies().summary()}
+
+
+def main(port, newhost, newport, options):
+    workers = options.pop('workers')
+    latency_file = options.pop('latency_file', None)
+    sink = None
+    if 'capture_file' in options:
+        sink = capture_file.BinaryCaptureSink(options.pop('capture_file'))
+        atexit.register(sink.close, 5)
+    supervisor = Supervisor(workers, port, newhost, newport, sink=sink, **options)
+    if latency_file is not None:
+        atexit.register(lambda: supervisor.latencies().dump(latency_file))
+    if options.get('instrumented'):
+        atexit.register(lambda: print_parser_stats(supervisor.metrics()["parser_stats"]))
+    # Stop the workers and write out the captures and latencies when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    supervisor.run()
@@ -0,0 +1,64 @@
+import io
+import threading
+
+import capture
+import http_parser
+import communication
+from parser_utils import intialize_parser, parse
+
+
+class SlowSink(capture.CaptureSink):
+    def __init__(self, **options):
+        self.written = []
+        self.threads = set()
+        self.release = threading.Event()
+        super().__init__(**options)
+
+    def write(self, request_response):
+        self.release.wait()
+        self.threads.add(threading.current_thread())
+        self.written.append(request_response)
+
+
+def test_full_sink_drops():
+    sink = SlowSink(max_pending=2, when_full='drop')
+    for i in range(10):
+        sink.put(i)
+    sink.release.set()
+    sink.close()
+
+    # One entry may already be in the writer when the queue fills up
+    assert sink.written in ([0, 1], [0, 1, 2])
+    assert sink.dropped == 10 - len(sink.written)
+    assert threading.current_thread() not in sink.threads
+
+
+def test_full_sink_blocks():
+    sink = SlowSink(max_pending=2, when_full='block')
+    producer = threading.Thread(target=lambda: [sink.put(i) for i in range(10)])
+    producer.start()
+    producer.join(0.1)
+    assert producer.is_alive()
+
+    sink.release.set()
+    producer.join()
+    sink.close()
+    assert sink.written == list(range(10))
+    assert sink.dropped == 0
+
+
+def test_text_sink_formats_snapshots():
+    stream = io.StringIO()
+    sink = capture.TextCaptureSink(stream)
+    comm = communication.Communication(sink)
+    parser = intialize_parser(http_parser.get_http_request)
+    request, = parse(parser, b"GET /a HTTP/1.1\r\nHost: example.com\r\n\r\n")
+    response, = parse(parser, b"HTTP/1.1 204 No Content\r\n\r\n")
+
+    comm.add_message(request, "request")
+    comm.add_message(response, "response")
+    sink.close()
+
+    _, first, second = stream.getvalue().split("Communication ")
+    assert "GET /a HTTP/1.1" in first and "RESPONSE:\nNone" in first
+    assert "HTTP/1.1 204 No Content" in second
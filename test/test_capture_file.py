@@ -0,0 +1,76 @@
+import capture_file
+import http_parser
+from communication import RequestResponse
+from parser_utils import parse, intialize_parser
+
+
+def parse_messages(data):
+    return list(parse(intialize_parser(http_parser.get_http_request), data))
+
+
+def test_write_then_read_back(tmp_path):
+    path = str(tmp_path / "capture.bin")
+    requests = parse_messages(b"GET /a HTTP/1.1\r\nHost: x\r\n\r\n"
+                              b"POST /b/c HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc")
+    responses = parse_messages(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+                               b"HTTP/1.1 404 Not Found\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nno\r\n0\r\n\r\n")
+
+    sink = capture_file.BinaryCaptureSink(path)
+    first = RequestResponse(requests[0])
+    first.request_first_byte_ns = 100
+    sink.put(first)
+    second = RequestResponse(requests[1], responses[1])
+    second.request_first_byte_ns = 200
+    sink.put(second)
+    sink.close()
+
+    with capture_file.CaptureReader(path) as reader:
+        assert len(reader) == 2
+        assert reader[0].path == b"/a" and reader[0].has_request and not reader[0].has_response
+        assert reader[0].request_first_byte_ns == 100 and reader[0].response_last_byte_ns is None
+
+        found, = reader.filter(method=b"POST", path=b"/b", status=404, complete=True, since_ns=150)
+        assert reader.get(second.guid) == found
+        loaded = reader.load(found)
+        assert loaded.guid == second.guid
+        assert loaded.request.body == b"abc"
+        assert loaded.response.status == b"404"
+        assert loaded.response.body == b"no"
+        assert loaded.response.headers[b"Transfer-Encoding"] == b"chunked"
+
+        assert reader.load(reader[0]).response is None
+
+
+def test_appends_and_ignores_unflushed_records(tmp_path):
+    path = str(tmp_path / "capture.bin")
+    request, = parse_messages(b"GET / HTTP/1.1\r\nHost: x\r\n\r\n")
+    for _ in range(2):
+        sink = capture_file.BinaryCaptureSink(path)
+        sink.put(RequestResponse(request))
+        sink.close()
+    with open(path + ".idx", "ab") as f:
+        f.write(b"partial entry")
+
+    with capture_file.CaptureReader(path) as reader:
+        assert [entry.offset for entry in reader] == [0, reader[0].length]
+
+
+def test_fields_too_long_for_the_index_are_clipped(tmp_path):
+    path = str(tmp_path / "capture.bin")
+    method = b"X" * 300
+    requests = parse_messages(b"GET /a HTTP/1.1\r\nHost: x\r\n\r\n"
+                              b"%s /b HTTP/1.1\r\nHost: x\r\n\r\n" % method +
+                              b"GET /c HTTP/1.1\r\nHost: x\r\n\r\n")
+    response, = parse_messages(b"HTTP/1.1 99999 Odd\r\nContent-Length: 0\r\n\r\n")
+
+    sink = capture_file.BinaryCaptureSink(path)
+    sink.put(RequestResponse(requests[0]))
+    sink.put(RequestResponse(requests[1], response))
+    sink.put(RequestResponse(requests[2]))
+    sink.close()
+
+    with capture_file.CaptureReader(path) as reader:
+        assert [entry.path for entry in reader] == [b"/a", b"/b", b"/c"]
+        assert reader[1].method == method[:255] and reader[1].status == 0
+        assert reader.load(reader[1]).request.method == method
+        assert reader.load(reader[2]).request.path == b"/c"
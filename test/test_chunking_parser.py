@@ -1,5 +1,5 @@
 import chunking_parser
-from parser_utils import parse
+from parser_utils import feed, parse
 
 
 def test_one():
@@ -34,3 +34,12 @@ def test_multiple():
     results += parse(parser, "de2\r\nXX")
 
     assert results == ["abcde", "XX"]
+
+
+def test_batch_feed():
+    parser = chunking_parser.prepare(batch=True)
+    next(parser)
+
+    assert feed(parser, "5\r\nabcde2\r\nXX3\r") == ["abcde", "XX"]
+    assert feed(parser, "\nab") == []
+    assert feed(parser, "c") == ["abc"]
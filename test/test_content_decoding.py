@@ -0,0 +1,80 @@
+import gzip
+import zlib
+
+import content_decoding
+import http_parser
+from parser_utils import intialize_parser, parse
+
+TEXT = b"".join(b"line %d of a long text body\n" % i for i in range(100000))
+
+
+def test_decoder_stops_at_limit():
+    body = gzip.compress(TEXT)
+    decoder = content_decoding.BodyDecoder(b"gzip", 100)
+
+    assert not decoder.feed(body[:len(body) // 2])
+    assert decoder.decoded == TEXT[:100]
+    assert decoder.truncated
+    # The rest of the input is left alone
+    assert decoder.decompressor.unconsumed_tail
+    assert not decoder.feed(body[len(body) // 2:])
+    assert decoder.decoded == TEXT[:100]
+
+
+def test_decoder_fed_in_fragments():
+    body = gzip.compress(b"short body")
+    decoder = content_decoding.BodyDecoder(b"gzip", 100)
+    for i in range(len(body)):
+        decoder.feed(body[i:i + 1])
+
+    assert decoder.decoded == b"short body"
+    assert decoder.done and not decoder.truncated
+
+
+def test_deflate_with_and_without_zlib_header():
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    raw = compressor.compress(TEXT[:1000]) + compressor.flush()
+
+    for body in (zlib.compress(TEXT[:1000]), raw):
+        assert content_decoding.preview(body, b"deflate", 50) == (TEXT[:50], True)
+
+
+def test_undecodable_body():
+    assert content_decoding.preview(b"not gzip at all", b"gzip", 50) is None
+    assert content_decoding.preview(b"abc", b"br", 50) is None
+    assert content_decoding.preview(b"abc", None, 2) == (b"ab", True)
+
+
+def test_message_shows_decoded_preview():
+    body = gzip.compress(TEXT)
+    msg = b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Encoding: gzip\r\n" + \
+          b"Content-Length: %d\r\n\r\n" % len(body) + body
+    response, = parse(intialize_parser(http_parser.get_http_request), msg)
+
+    shown = response.format(preview_length=20)
+    assert shown.endswith(str(TEXT[:20]) + "... (truncated)\n")
+    assert response.preview(20) == (TEXT[:20], True, True)
+
+
+def test_binary_body_hex_is_limited_to_preview():
+    msg = b"HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n" + b"\x01" * 1000
+    response, = parse(intialize_parser(http_parser.get_http_request), msg)
+
+    assert str(response).endswith("01" * http_parser.PREVIEW_LENGTH + "... (truncated)\n")
+
+
+def test_deflate_fed_byte_by_byte():
+    body = zlib.compress(b"short body")
+    decoder = content_decoding.BodyDecoder(b"deflate", 100)
+    for i in range(len(body)):
+        decoder.feed(body[i:i + 1])
+
+    assert decoder.decoded == b"short body"
+    assert decoder.done and not decoder.failed
+
+
+def test_cut_body_preview_is_truncated():
+    body = zlib.compress(TEXT[:1000], 0)
+
+    assert content_decoding.preview(body[:40], b"deflate", 75) == (TEXT[:40 - 7], True)
+    assert content_decoding.preview(b"", b"gzip", 75) == (b"", False)
@@ -1,5 +1,5 @@
 import delimiting_parser
-from parser_utils import parse
+from parser_utils import feed, parse
 
 
 def test_whole_sentences():
@@ -35,3 +35,12 @@ def test_split():
     results += parse(parser, "third.forth.")
 
     assert results == ["first", "second", "third", "forth"]
+
+
+def test_batch_feed():
+    parser = delimiting_parser.prepare(".", batch=True)
+    next(parser)
+
+    assert feed(parser, "first.second.th") == ["first", "second"]
+    assert feed(parser, "ird") == []
+    assert feed(parser, ".forth.") == ["third", "forth"]
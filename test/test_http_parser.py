@@ -1,5 +1,16 @@
+import functools
+import mmap
+
+import pytest
+
+import flat_http_parser
 import http_parser
-from parser_utils import parse, intialize_parser
+from parser_utils import Buffer, LimitExceeded, feed, parse, intialize_parser
+
+
+@pytest.fixture(params=[http_parser.get_http_request, flat_http_parser.get_http_request], ids=["combinators", "flat"])
+def get_http_request(request):
+    return request.param
 
 
 def chunks(l, n):
@@ -8,10 +19,10 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
-def test_two_requests_whole():
+def test_two_requests_whole(get_http_request):
     msg = b"GET / HTTP/1.1\r\nHost: www.example.com\r\n\r\nGET / HTTP/1.1\r\nHost: www.example.com\r\n\r\n"
 
-    parser = intialize_parser(http_parser.get_http_request)
+    parser = intialize_parser(get_http_request)
     parsed_messages = list(parse(parser, msg))
 
     assert len(parsed_messages) == 2
@@ -22,11 +33,11 @@ def test_two_requests_whole():
         assert parsed_message.path == b"/"
 
 
-def test_two_requests_in_pieces():
+def test_two_requests_in_pieces(get_http_request):
     msg = b"GET / HTTP/1.1\r\nHost: www.example.com\r\n\r\nGET / HTTP/1.1\r\nHost: www.example.com\r\n\r\n"
     msgs = chunks(msg, 15)
 
-    parser = intialize_parser(http_parser.get_http_request)
+    parser = intialize_parser(get_http_request)
     parsed_messages = []
 
     for data in msgs:
@@ -40,7 +51,7 @@ def test_two_requests_in_pieces():
         assert parsed_message.path == b"/"
 
 
-def test_two_responses_whole():
+def test_two_responses_whole(get_http_request):
     msg = b"HTTP/1.1 200 OK\r\n" + \
           b"Content-Type: text/plain; charset=utf-8\r\n" + \
           b"Content-Length: 6\r\n" + \
@@ -48,7 +59,7 @@ def test_two_responses_whole():
           b"abcd\r\n"
 
     msg = msg * 2
-    parser = intialize_parser(http_parser.get_http_request)
+    parser = intialize_parser(get_http_request)
     parsed_messages = list(parse(parser, msg))
 
     assert len(parsed_messages) == 2
@@ -57,13 +68,13 @@ def test_two_responses_whole():
         assert parsed_message.body == b"abcd\r\n"
 
 
-def test_one_response_no_length():
+def test_one_response_no_length(get_http_request):
     msg = b"HTTP/1.1 200 OK\r\n" + \
           b"Content-Type: text/plain; charset=utf-8\r\n" + \
           b"\r\n" + \
           b"abcd\r\n"
 
-    parser = intialize_parser(http_parser.get_http_request)
+    parser = intialize_parser(get_http_request)
     parsed_messages = list(parse(parser, msg))
 
     assert len(parsed_messages) == 1
@@ -72,7 +83,7 @@ def test_one_response_no_length():
         assert parsed_message.body == b"abcd\r\n"
 
 
-def test_two_responses_in_pieces():
+def test_two_responses_in_pieces(get_http_request):
     msg = b"HTTP/1.1 200 OK\r\n" + \
           b"Content-Type: text/plain; charset=utf-8\r\n" + \
           b"Content-Length: 6\r\n" + \
@@ -80,7 +91,7 @@ def test_two_responses_in_pieces():
           b"abcd\r\n"
 
     msg = msg * 3
-    parser = intialize_parser(http_parser.get_http_request)
+    parser = intialize_parser(get_http_request)
     msgs = chunks(msg, 15)
     parsed_messages = []
 
@@ -93,7 +104,7 @@ def test_two_responses_in_pieces():
         assert parsed_message.body == b"abcd\r\n"
 
 
-def test_one_response_chunked_whole():
+def test_one_response_chunked_whole(get_http_request):
     msg = b"HTTP/1.1 200 OK\r\n" + \
           b"Content-Type: text/plain; charset=utf-8\r\n" + \
           b"Transfer-Encoding: chunked\r\n" + \
@@ -109,7 +120,7 @@ def test_one_response_chunked_whole():
           b"0\r\n" + \
           b"\r\n"
 
-    parser = intialize_parser(http_parser.get_http_request)
+    parser = intialize_parser(get_http_request)
     parsed_messages = list(parse(parser, msg))
     assert len(parsed_messages) == 1
     for parsed_message in parsed_messages:
@@ -117,7 +128,7 @@ def test_one_response_chunked_whole():
         assert parsed_message.body == b"Wikipedia in\r\n\r\nchunks."
 
 
-def test_one_response_chunked_in_parts():
+def test_one_response_chunked_in_parts(get_http_request):
     msg = b"HTTP/1.1 200 OK\r\n" + \
           b"Content-Type: text/plain; charset=utf-8\r\n" + \
           b"Transfer-Encoding: chunked\r\n" + \
@@ -133,7 +144,7 @@ def test_one_response_chunked_in_parts():
           b"0\r\n" + \
           b"\r\n"
 
-    parser = intialize_parser(http_parser.get_http_request)
+    parser = intialize_parser(get_http_request)
     msgs = chunks(msg, 15)
     parsed_messages = []
 
@@ -146,7 +157,7 @@ def test_one_response_chunked_in_parts():
         assert parsed_message.body == b"Wikipedia in\r\n\r\nchunks."
 
 
-def test_two_responses_chunked():
+def test_two_responses_chunked(get_http_request):
     msg = b"HTTP/1.1 200 OK\r\n" + \
           b"Content-Type: text/plain; charset=utf-8\r\n" + \
           b"Transfer-Encoding: chunked\r\n" + \
@@ -163,7 +174,7 @@ def test_two_responses_chunked():
           b"\r\n"
 
     msg = msg * 2
-    parser = intialize_parser(http_parser.get_http_request)
+    parser = intialize_parser(get_http_request)
     parsed_messages = list(parse(parser, msg))
 
     assert len(parsed_messages) == 2
@@ -172,7 +183,7 @@ def test_two_responses_chunked():
         assert parsed_message.body == b"Wikipedia in\r\n\r\nchunks."
 
 
-def test_two_responses_chunked_in_parts():
+def test_two_responses_chunked_in_parts(get_http_request):
     msg = b"HTTP/1.1 200 OK\r\n" + \
           b"Content-Type: text/plain; charset=utf-8\r\n" + \
           b"Transfer-Encoding: chunked\r\n" + \
@@ -189,7 +200,7 @@ def test_two_responses_chunked_in_parts():
           b"\r\n"
 
     msg = msg * 2
-    parser = intialize_parser(http_parser.get_http_request)
+    parser = intialize_parser(get_http_request)
 
     msgs = chunks(msg, 15)
     parsed_messages = []
@@ -201,3 +212,309 @@ def test_two_responses_chunked_in_parts():
     for parsed_message in parsed_messages:
         assert parsed_message.headers[b'Content-Type'] == b"text/plain; charset=utf-8"
         assert parsed_message.body == b"Wikipedia in\r\n\r\nchunks."
+
+
+CHUNKED_WITH_TRAILERS = b"HTTP/1.1 200 OK\r\n" + \
+                        b"Transfer-Encoding: chunked\r\n" + \
+                        b"Trailer: Expires\r\n" + \
+                        b"\r\n" + \
+                        b"4;name=value\r\n" + \
+                        b"Wiki\r\n" + \
+                        b"0\r\n" + \
+                        b"Expires: never\r\n" + \
+                        b"X-Checksum: 1234\r\n" + \
+                        b"\r\n"
+
+
+def test_chunked_trailers_whole_and_in_pieces(get_http_request):
+    for size in (len(CHUNKED_WITH_TRAILERS) * 2, 1, 5):
+        parser = intialize_parser(get_http_request)
+        parsed_messages = []
+        for data in chunks(CHUNKED_WITH_TRAILERS * 2, size):
+            parsed_messages += parse(parser, data)
+
+        assert len(parsed_messages) == 2
+        for parsed_message in parsed_messages:
+            assert parsed_message.body == b"Wiki"
+            assert parsed_message.trailers.items() == [(b"Expires", b"never"), (b"X-Checksum", b"1234")]
+            assert b"".join(parsed_message.last_chunk_to_bytes()) == CHUNKED_WITH_TRAILERS[CHUNKED_WITH_TRAILERS.index(b"0\r\n"):]
+
+
+def test_messages_stream_only_chunked_bodies():
+    msg = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok" + CHUNKED_WITH_TRAILERS
+    parser = intialize_parser(http_parser.get_http_messages)
+    items = []
+    for data in chunks(msg, 7):
+        items += parse(parser, data)
+
+    assert isinstance(items[0], http_parser.HttpResponse) and items[0].body == b"ok"
+    assert isinstance(items[1], http_parser.HttpHeaders)
+    assert b"".join(item.data for item in items[2:-1]) == b"Wiki"
+    assert isinstance(items[-1], http_parser.HttpEndOfMessage)
+    assert items[-1].message.trailers[b"x-checksum"] == b"1234"
+
+
+@pytest.mark.parametrize("get_http_messages", [http_parser.get_http_messages, http_parser.get_http_events])
+def test_splice_leaves_unreceived_body_to_caller(get_http_messages):
+    first = b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n0123"
+    second = b"HTTP/1.1 204 No Content\r\n\r\n"
+    parser = intialize_parser(functools.partial(get_http_messages, splice=True), batch=True)
+
+    events = feed(parser, first)
+    # The caller moves the other 6 bytes of the body itself, the parser goes on with the next message
+    events += feed(parser, second)
+
+    assert [type(event) for event in events[:4]] == [http_parser.HttpHeaders, http_parser.HttpBodyFragment,
+                                                      http_parser.HttpBodySplice, http_parser.HttpEndOfMessage]
+    assert events[1].data == b"0123"
+    assert events[2].count == 6
+    assert getattr(events[-1], "message", events[-1]).status == b"204"
+
+
+@pytest.mark.parametrize("get_http_messages", [http_parser.get_http_messages, http_parser.get_http_events,
+                                               http_parser.get_http_frames])
+def test_responses_to_head_have_no_body(get_http_messages):
+    msg = b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n" + b"HTTP/1.1 204 No Content\r\n\r\n"
+    parser = intialize_parser(functools.partial(get_http_messages, request_method=b"HEAD"), batch=True)
+
+    messages = [getattr(item, "message", item) for item in feed(parser, msg)
+                if isinstance(item, (http_parser.HttpResponse, http_parser.HttpEndOfMessage))]
+
+    assert [message.status for message in messages] == [b"200", b"204"]
+    assert not messages[0].has_body()
+
+
+def test_messages_stream_long_bodies():
+    msg = b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nabcd" + \
+          b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nabcde" + \
+          b"HTTP/1.1 200 OK\r\n\r\nto the end"
+    parser = intialize_parser(functools.partial(http_parser.get_http_messages, stream_above=4), batch=True)
+    items = []
+    for data in chunks(msg, 3):
+        items += feed(parser, data)
+    items += feed(parser, b"")
+
+    assert items[0].body == b"abcd"
+    ends = [item for item in items if isinstance(item, http_parser.HttpEndOfMessage)]
+    assert len(ends) == 2
+    assert b"".join(item.data for item in items if isinstance(item, http_parser.HttpBodyFragment)) == \
+           b"abcdeto the end"
+    assert all(len(item.data) <= 3 for item in items if isinstance(item, http_parser.HttpBodyFragment))
+
+
+def stream_events(msgs):
+    parser = intialize_parser(http_parser.get_http_events)
+    events = []
+    for data in msgs:
+        events += parse(parser, data)
+    return events
+
+
+def test_stream_response_in_pieces():
+    msg = b"HTTP/1.1 200 OK\r\n" + \
+          b"Content-Type: text/plain; charset=utf-8\r\n" + \
+          b"Content-Length: 6\r\n" + \
+          b"\r\n" + \
+          b"abcd\r\n"
+
+    events = stream_events(chunks(msg * 2, 15))
+
+    assert [type(event) for event in events if not isinstance(event, http_parser.HttpBodyFragment)] == \
+           [http_parser.HttpHeaders, http_parser.HttpEndOfMessage] * 2
+    assert all(len(event.data) <= 15 for event in events if isinstance(event, http_parser.HttpBodyFragment))
+    assert b"".join(event.data for event in events if isinstance(event, http_parser.HttpBodyFragment)) == \
+           b"abcd\r\n" * 2
+    assert events[0].message.headers[b'Content-Type'] == b"text/plain; charset=utf-8"
+    assert events[0].message.body == None
+
+
+def test_stream_chunked_response_in_pieces():
+    msg = b"HTTP/1.1 200 OK\r\n" + \
+          b"Transfer-Encoding: chunked\r\n" + \
+          b"\r\n" + \
+          b"4\r\n" + \
+          b"Wiki\r\n" + \
+          b"5\r\n" + \
+          b"pedia\r\n" + \
+          b"E\r\n" + \
+          b" in\r\n" + \
+          b"\r\n" + \
+          b"chunks.\r\n" + \
+          b"0\r\n" + \
+          b"\r\n"
+
+    events = stream_events(chunks(msg, 7))
+
+    assert isinstance(events[0], http_parser.HttpHeaders)
+    assert isinstance(events[-1], http_parser.HttpEndOfMessage)
+    fragments = events[1:-1]
+    assert all(isinstance(event, http_parser.HttpBodyFragment) for event in fragments)
+    assert b"".join(event.data for event in fragments) == b"Wikipedia in\r\n\r\nchunks."
+
+
+def test_stream_response_no_length_until_end_of_stream():
+    msg = b"HTTP/1.1 200 OK\r\n" + \
+          b"Content-Type: text/plain; charset=utf-8\r\n" + \
+          b"\r\n" + \
+          b"abcd\r\n"
+
+    events = stream_events(list(chunks(msg, 15)) + [b"more", b""])
+
+    assert isinstance(events[-1], http_parser.HttpEndOfMessage)
+    assert b"".join(event.data for event in events[1:-1]) == b"abcd\r\nmore"
+
+
+def test_zero_copy_responses_in_pieces(get_http_request):
+    msg = b"HTTP/1.1 200 OK\r\n" + \
+          b"Content-Type: text/plain; charset=utf-8\r\n" + \
+          b"Content-Length: 6\r\n" + \
+          b"\r\n" + \
+          b"abcd\r\n"
+
+    parser = intialize_parser(get_http_request, Buffer(zero_copy=True))
+    parsed_messages = []
+
+    for data in chunks(msg * 3, 15):
+        parsed_messages += parse(parser, data)
+
+    assert len(parsed_messages) == 3
+    for parsed_message in parsed_messages:
+        assert isinstance(parsed_message.body, memoryview)
+        assert isinstance(parsed_message.headers[b'Content-Type'], memoryview)
+        assert parsed_message.headers[b'Content-Type'] == b"text/plain; charset=utf-8"
+        assert parsed_message.body == b"abcd\r\n"
+        assert b"".join(parsed_message.to_bytes()) == msg
+
+
+def test_batch_feed(get_http_request):
+    msg = b"HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\nabcd\r\n"
+    parser = intialize_parser(get_http_request, batch=True)
+
+    assert [m.body for m in feed(parser, msg * 3 + msg[:20])] == [b"abcd\r\n"] * 3
+    assert [m.body for m in feed(parser, msg[20:] + msg)] == [b"abcd\r\n"] * 2
+
+    # Without a length, the body runs until an empty feed marks the end of the stream
+    assert feed(parser, b"HTTP/1.1 200 OK\r\n\r\nab") == []
+    assert feed(parser, b"cd") == []
+    assert [m.body for m in feed(parser, b"")] == [b"abcd"]
+
+
+def test_headers_are_case_insensitive_and_lazy(get_http_request):
+    msg = b"HTTP/1.1 200 OK\r\n" + \
+          b"content-length: 4\r\n" + \
+          b"Set-Cookie: a=1\r\n" + \
+          b"Set-Cookie: b=2\r\n" + \
+          b"\r\n" + \
+          b"abcd"
+
+    parser = intialize_parser(get_http_request)
+    parsed_message, = parse(parser, msg)
+
+    assert parsed_message.body == b"abcd"
+    assert parsed_message.headers[b"Content-Length"] == b"4"
+    assert parsed_message.headers[b"SET-COOKIE"] == b"b=2"
+    assert b"Host" not in parsed_message.headers
+    assert parsed_message.headers.field_range(b"Content-Length") == (0, 17)
+    assert parsed_message.headers.field_range(b"Host") is None
+    assert parsed_message.headers.raw == b"content-length: 4\r\nSet-Cookie: a=1\r\nSet-Cookie: b=2\r\n"
+    assert not hasattr(parsed_message, "__dict__")
+
+
+def test_changed_headers_keep_order(get_http_request):
+    msg = b"GET / HTTP/1.1\r\nHost: localhost\r\nAccept: */*\r\nConnection: close\r\n\r\n"
+    parser = intialize_parser(get_http_request)
+    parsed_message, = parse(parser, msg)
+
+    headers = parsed_message.headers.copy()
+    headers[b"host"] = b"www.example.com"
+    del headers[b"Connection"]
+    headers[b"X-Forwarded-For"] = b"127.0.0.1"
+
+    assert headers.items() == [(b"Host", b"www.example.com"), (b"Accept", b"*/*"),
+                               (b"X-Forwarded-For", b"127.0.0.1")]
+    assert parsed_message.headers[b"Host"] == b"localhost"
+    assert len(parsed_message.headers) == 3
+    assert headers.field_range(b"Accept") is None
+
+
+def test_obs_fold_whole_and_in_pieces(get_http_request):
+    msg = b"GET / HTTP/1.1\r\n" + \
+          b"X-Folded: first\r\n" + \
+          b"  second\r\n" + \
+          b"\tthird\r\n" + \
+          b"Host: www.example.com\r\n" + \
+          b"\r\n"
+
+    for pieces in ([msg], chunks(msg, 1)):
+        parser = intialize_parser(get_http_request)
+        parsed_messages = []
+        for data in pieces:
+            parsed_messages += parse(parser, data)
+
+        assert len(parsed_messages) == 1
+        assert parsed_messages[0].headers[b"X-Folded"] == b"first second third"
+        assert parsed_messages[0].headers[b"Host"] == b"www.example.com"
+
+
+def test_malformed_header_line(get_http_request):
+    for pieces in ([b"GET / HTTP/1.1\r\nHost\r\n\r\n"], chunks(b"GET / HTTP/1.1\r\nHost\r\n\r\n", 1)):
+        parser = intialize_parser(get_http_request)
+        try:
+            for data in pieces:
+                list(parse(parser, data))
+        except ValueError:
+            continue
+        assert False, "ValueError not raised"
+
+
+def test_malformed_first_line(get_http_request):
+    parser = intialize_parser(get_http_request)
+    with pytest.raises(ValueError):
+        list(parse(parser, b"GET /\r\nHost: x\r\n\r\n"))
+    for line in (b"GET /", b"HTTP/1.1"):
+        with pytest.raises(ValueError):
+            http_parser.parse_head(line + b"\r\nHost: x\r\n\r\n")
+
+
+def parse_with_limits(get_http_request, pieces, **limits):
+    data = Buffer()
+    data.limits = http_parser.HttpLimits(**limits)
+    parser = intialize_parser(get_http_request, data, batch=True)
+    messages = []
+    for piece in pieces:
+        messages += feed(parser, piece)
+    return messages
+
+
+@pytest.mark.parametrize("msg, limits", [
+    (b"GET /" + b"x" * 100 + b" HTTP/1.1\r\n\r\n", {"max_line": 64}),
+    (b"GET / HTTP/1.1\r\nX-Long: " + b"x" * 100 + b"\r\n\r\n", {"max_line": 64}),
+    (b"GET / HTTP/1.1\r\nX-Long: " + b"x" * 100 + b"\r\nX-A: 1\r\n", {"max_line": 64}),
+    (b"GET / HTTP/1.1\r\nX-A: 1\r\nX-Long: " + b"x" * 100, {"max_line": 64}),
+    (b"GET / HTTP/1.1\r\n" + b"X-A: 1\r\n" * 20 + b"\r\n", {"max_headers": 100}),
+    (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n" + b"0" * 100 + b"1\r\nx\r\n0\r\n\r\n",
+     {"max_line": 64}),
+], ids=["first line", "header line", "header line of unfinished block", "unfinished header line", "header block",
+        "chunk size"])
+def test_limits_whole_and_in_pieces(get_http_request, msg, limits):
+    for pieces in ([msg], chunks(msg, 7)):
+        with pytest.raises(LimitExceeded):
+            parse_with_limits(get_http_request, pieces, **limits)
+
+    ok = b"GET /x HTTP/1.1\r\nX-A: 1\r\n\r\n"
+    assert parse_with_limits(get_http_request, chunks(ok, 3), max_line=16, max_headers=8)[0].path == b"/x"
+
+
+def test_long_bodies_spool_to_file(get_http_request):
+    body = bytes(range(256)) * 4
+    msgs = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body) + body + \
+           b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n" + \
+           b"".join(b"%x\r\n%s\r\n" % (100, body[i:i + 100]) for i in range(0, 1000, 100)) + \
+           b"18\r\n" + body[1000:] + b"\r\n0\r\n\r\n" + \
+           b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok" + \
+           b"HTTP/1.1 200 OK\r\n\r\n" + body
+
+    for pieces in ([msgs, b""], list(chunks(msgs, 50)) + [b""]):
+        messages = parse_with_limits(get_http_request, pieces, max_body_in_memory=512)
+        assert [bytes(message.body) for message in messages] == [body, body, b"ok", body]
+        assert [isinstance(message.body, mmap.mmap) for message in messages] == [True, True, False, True]
@@ -0,0 +1,28 @@
+import json
+
+import latency
+
+
+def test_histogram_percentiles():
+    histogram = latency.LatencyHistogram()
+    for value in range(1, 10001):
+        histogram.record(value * 1000)
+
+    summary = histogram.summary()
+    assert summary["count"] == 10000
+    assert summary["max"] == 10000000
+    for name, expected in (("p50", 5000000), ("p99", 9900000), ("p999", 9990000)):
+        assert expected <= summary[name] <= expected * 65 / 64
+
+
+def test_recorder_by_upstream_and_dump(tmp_path):
+    recorder = latency.LatencyRecorder()
+    recorder.record("a:80", 100)
+    recorder.record("b:80", 5)
+
+    assert recorder.summary("a:80")["p50"] == 100
+    assert recorder.summary("c:80") is None
+
+    path = tmp_path / "latency.json"
+    recorder.dump(str(path))
+    assert json.loads(path.read_text())["b:80"]["count"] == 1
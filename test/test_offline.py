@@ -0,0 +1,27 @@
+import offline
+
+REQUEST = b"GET /%d HTTP/1.1\r\nHost: www.example.com\r\n\r\n"
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\nabcd\r\n"
+
+
+def record(directory, name, count, last_response=RESPONSE):
+    (directory / (name + ".request")).write_bytes(b"".join(REQUEST % i for i in range(count)))
+    (directory / (name + ".response")).write_bytes(RESPONSE * (count - 1) + last_response)
+
+
+def test_parse_connections_in_order(tmp_path):
+    record(tmp_path, "b", 3)
+    record(tmp_path, "a", 2, b"HTTP/1.0 200 OK\r\n\r\nrest of the stream")
+    (tmp_path / "c.request").write_bytes(REQUEST % 0)
+
+    connections = offline.find_connections(str(tmp_path))
+    assert [name for name, _, _ in connections] == ["a", "b", "c"]
+
+    for workers in (1, 2):
+        results = list(offline.parse_connections(connections, workers))
+        assert [name for name, _ in results] == ["a", "b", "c"]
+        (_, a), (_, b), (_, c) = results
+        assert [pair.request.path for pair in b] == [b"/0", b"/1", b"/2"]
+        assert [pair.response.body for pair in b] == [b"abcd\r\n"] * 3
+        assert a[1].response.body == b"rest of the stream"
+        assert c[0].request.path == b"/0" and c[0].response is None
@@ -0,0 +1,156 @@
+import mmap
+
+import pytest
+
+from parser_utils import Buffer, InstrumentedBuffer, LimitExceeded, SpooledBytes, intialize_parser, parse, get_bytes, \
+    get_until, get_word
+
+
+def test_buffer_take_and_find():
+    data = Buffer(b"abc\r\n")
+    data.extend(b"def")
+
+    assert len(data) == 8
+    assert data.find(b"\r\n") == 3
+    assert data.take(3) == b"abc"
+    data.skip(2)
+    assert data.find(b"\r\n") == -1
+    assert data.take_all() == b"def"
+    assert not data
+
+
+def test_buffer_keeps_unread_tail_when_compacting():
+    data = Buffer(b"x" * 10)
+    data.take(8)
+    data.extend(b"yz")
+
+    assert len(data) == 4
+    assert data.take_all() == b"xxyz"
+
+
+def test_buffer_text():
+    data = Buffer("ab")
+    data.extend("cd")
+    assert data.take(3) == "abc"
+    assert data.take_all() == "d"
+
+
+def test_large_message_in_small_pieces():
+    def get_message(data):
+        return get_bytes(data, 1024 * 1024)
+
+    msg = bytes(range(256)) * 4096 * 2
+    parser = intialize_parser(get_message)
+    parsed_messages = []
+    for i in range(0, len(msg), 1024):
+        parsed_messages += parse(parser, msg[i:i + 1024])
+
+    assert parsed_messages == [msg[:1024 * 1024], msg[1024 * 1024:]]
+
+
+def test_delimiter_split_across_chunks():
+    def get_line(data):
+        return get_until(data, b"\r\n\r\n")
+
+    parser = intialize_parser(get_line)
+    parsed_messages = []
+    for data in (b"abc\r", b"\n", b"\r", b"\ndef\r\n", b"\r\n"):
+        parsed_messages += parse(parser, data)
+
+    assert parsed_messages == [b"abc", b"def"]
+
+
+def test_words_split_across_chunks():
+    def get_two_words(data):
+        first, data = yield from get_word(data)
+        second, data = yield from get_word(data)
+        return (first, second), data
+
+    parser = intialize_parser(get_two_words)
+    parsed_messages = []
+    for data in b"GET  /index.html\tHTTP/1.1\r\nX":
+        parsed_messages += parse(parser, bytes([data]))
+
+    assert parsed_messages == [(b"GET", b"/index.html")]
+
+
+def test_buffer_views_survive_new_data():
+    data = Buffer(b"abcdef", zero_copy=True)
+    view = data.take(3, view=True)
+    data.extend(b"ghi")
+
+    assert view == b"abc"
+    assert data.take_all() == b"defghi"
+
+
+def test_instrumented_buffer_counts():
+    def get_line(data):
+        return get_until(data, b"\r\n")
+
+    data = InstrumentedBuffer()
+    parser = intialize_parser(get_line, data)
+    results = []
+    for piece in (b"ab", b"c\r", b"\ndef\r\n"):
+        results += parse(parser, piece)
+
+    stats = data.stats.snapshot()
+    assert results == [b"abc", b"def"]
+    assert stats["messages"] == 2
+    assert stats["bytes_consumed"] == 10
+    # parse resumes the parser once more without data after each piece, which searches again
+    assert stats["rescans"] == 5
+    assert stats["bytes_copied"] >= 10
+    assert stats["resumptions"] >= 3
+
+
+def test_str_chunks_are_joined_once_looked_into():
+    def get_line_and_value(data):
+        line, data = yield from get_until(data, "\r\n")
+        return (yield from get_bytes(data, int(line)))
+
+    value = "x" * 100000
+    data = InstrumentedBuffer()
+    parser = intialize_parser(get_line_and_value, data)
+    message = "%d\r\n" % len(value) + value
+    results = []
+    for start in range(0, len(message), 100):
+        results += parse(parser, message[start:start + 100])
+
+    assert results == [value]
+    # Every character is copied into the buffer, once more when the chunks are joined and once when taken
+    assert data.stats.bytes_copied <= 3 * len(message)
+
+
+def test_spooled_bytes_spill_to_file():
+    value = SpooledBytes(4)
+    value.write(b"abc")
+    assert value.file is None
+    value.write(memoryview(b"defg"))
+
+    body = value.getvalue()
+    assert isinstance(body, mmap.mmap)
+    assert body[:] == b"abcdefg"
+    assert SpooledBytes(4).getvalue() == b""
+
+
+def test_get_bytes_spools_beyond_max_in_memory():
+    def get_body(data):
+        return (yield from get_bytes(data, 10, max_in_memory=4))
+
+    parser = intialize_parser(get_body)
+    results = []
+    for piece in (b"0123", b"4567", b"89"):
+        results += parse(parser, piece)
+
+    assert isinstance(results[0], mmap.mmap) and results[0][:] == b"0123456789"
+
+
+def test_get_until_limit():
+    def get_line(data):
+        return (yield from get_until(data, b"\r\n", limit=5))
+
+    assert list(parse(intialize_parser(get_line), b"abcde\r\n")) == [b"abcde"]
+    parser = intialize_parser(get_line)
+    list(parse(parser, b"abc"))
+    with pytest.raises(LimitExceeded):
+        list(parse(parser, b"def"))
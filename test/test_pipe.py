@@ -0,0 +1,641 @@
+import asyncio
+import socket
+import threading
+import time
+import zlib
+
+import pytest
+
+import async_pipe
+import latency
+import pipe
+from upstream_pool import UpstreamPool
+
+
+class CollectingCommunication(pipe.Communication):
+    def __init__(self):
+        super().__init__()
+        self.request_responses = []
+
+    def have_request_response(self, request_response):
+        self.request_responses.append(request_response)
+
+
+def test_async_pipe_rewrites_host():
+    async def run():
+        source, source_peer = socket.socketpair()
+        sink, sink_peer = socket.socketpair()
+        reader, source_writer = await asyncio.open_connection(sock=source)
+        sink_reader, writer = await asyncio.open_connection(sock=sink)
+        comm = CollectingCommunication()
+
+        with source_peer, sink_peer:
+            source_peer.sendall(b"GET / HTTP/1.1\r\nHost: localhost:8003\r\n\r\n")
+            source_peer.shutdown(socket.SHUT_WR)
+            await async_pipe.AsyncPipe(reader, writer, 'request', comm, 'www.example.com', 80).run()
+            writer.close()
+            source_writer.close()
+
+            forwarded = b""
+            data = sink_peer.recv(1024)
+            while data:
+                forwarded += data
+                data = sink_peer.recv(1024)
+        return forwarded, comm
+
+    forwarded, comm = asyncio.run(run())
+
+    assert forwarded == b"GET / HTTP/1.1\r\nHost: www.example.com\r\n\r\n"
+    assert len(comm.request_responses) == 1
+    assert comm.request_responses[0].request.path == b"/"
+
+
+def run_pipe_thread(tag, pieces, **options):
+    source, source_peer = socket.socketpair()
+    sink, sink_peer = socket.socketpair()
+    comm = CollectingCommunication()
+    with source, source_peer, sink, sink_peer:
+        thread = pipe.PipeThread(source, sink, tag, comm, 'www.example.com', 80, **options)
+        thread.start()
+        for piece in pieces:
+            source_peer.sendall(piece)
+        source_peer.shutdown(socket.SHUT_WR)
+
+        forwarded = b""
+        data = sink_peer.recv(1024)
+        while data:
+            forwarded += data
+            data = sink_peer.recv(1024)
+        thread.join()
+    return forwarded, comm
+
+
+def test_raw_pipe_forwards_original_bytes():
+    msg = b"HTTP/1.1 200 OK\r\n" + \
+          b"Transfer-Encoding: chunked\r\n" + \
+          b"\r\n" + \
+          b"4\r\n" + \
+          b"Wiki\r\n" + \
+          b"0\r\n" + \
+          b"\r\n" + \
+          b"HTTP/1.1 404 Not Found\r\n" + \
+          b"Content-Length: 3\r\n" + \
+          b"\r\n" + \
+          b"abc"
+
+    forwarded, comm = run_pipe_thread('response', [msg[i:i + 7] for i in range(0, len(msg), 7)], raw=True)
+
+    assert forwarded == msg
+    assert [rr.response.status for rr in comm.request_responses] == [b"200", b"404"]
+    assert comm.request_responses[1].response.body_range == (len(msg) - 3, len(msg))
+
+
+def test_pipe_forwards_chunks_as_they_arrive():
+    msg = b"HTTP/1.1 200 OK\r\n" + \
+          b"Transfer-Encoding: chunked\r\n" + \
+          b"\r\n" + \
+          b"4\r\n" + \
+          b"Wiki\r\n" + \
+          b"5\r\n" + \
+          b"pedia\r\n" + \
+          b"0\r\n" + \
+          b"Expires: never\r\n" + \
+          b"\r\n"
+
+    forwarded, comm = run_pipe_thread('response', [msg], capture_body_limit=6)
+
+    assert forwarded == msg
+    response = comm.request_responses[0].response
+    assert response.body == b"Wikipe"
+    assert response.trailers[b"Expires"] == b"never"
+
+
+def test_raw_pipe_rewrites_host():
+    msg = b"GET / HTTP/1.1\r\nHost: localhost:8003\r\nAccept: */*\r\n\r\n"
+
+    forwarded, comm = run_pipe_thread('request', [msg * 2], raw=True)
+
+    assert forwarded == b"GET / HTTP/1.1\r\nHost: www.example.com\r\nAccept: */*\r\n\r\n" * 2
+
+
+class ShortWritingSocket:
+    def __init__(self):
+        self.sent = b""
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        data = b"".join(buffers)[:5]
+        self.sent += data
+        return len(data)
+
+
+def test_send_request_handles_short_writes():
+    source, sink = socket.socketpair()
+    with source, sink:
+        thread = pipe.PipeThread(source, sink, 'response', CollectingCommunication(), 'www.example.com', 80)
+        thread.sink = ShortWritingSocket()
+        parser = pipe.intialize_parser(pipe.http_parser.get_http_request)
+        msg = b"HTTP/1.1 200 OK\r\nContent-Length: 6\r\nX-A: 1\r\n\r\nabcd\r\n"
+
+        for message in pipe.parse(parser, msg):
+            thread.send_request(message)
+
+    assert thread.sink.sent == msg
+    assert thread.sink.calls == (len(msg) + 4) // 5
+    pipe.PipeThread.pipes.remove(thread)
+
+
+def test_instrumented_pipe_stats_are_aggregated():
+    msg = b"HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\nabcd\r\n"
+    before = pipe.PipeThread.parser_stats_total()
+
+    forwarded, comm = run_pipe_thread('response', [msg[:10], msg[10:] + msg], instrumented=True)
+
+    after = pipe.PipeThread.parser_stats_total()
+    assert forwarded == msg * 2
+    assert after["messages"] - before["messages"] == 2
+    assert after["bytes_consumed"] - before["bytes_consumed"] == len(msg) * 2
+    assert after["seconds"] > before["seconds"]
+
+
+def test_instrumented_async_pipe_stats_are_aggregated():
+    async def run():
+        source, source_peer = socket.socketpair()
+        sink, sink_peer = socket.socketpair()
+        reader, source_writer = await asyncio.open_connection(sock=source)
+        sink_reader, writer = await asyncio.open_connection(sock=sink)
+
+        with source_peer, sink_peer:
+            source_peer.sendall(b"GET / HTTP/1.1\r\nHost: localhost:8003\r\n\r\n")
+            source_peer.shutdown(socket.SHUT_WR)
+            await async_pipe.AsyncPipe(reader, writer, 'request', CollectingCommunication(), 'www.example.com', 80,
+                                       instrumented=True).run()
+            writer.close()
+            source_writer.close()
+
+    before = pipe.PipeThread.parser_stats_total()
+    asyncio.run(run())
+    after = pipe.PipeThread.parser_stats_total()
+
+    assert after["messages"] - before["messages"] == 1
+
+
+def test_exchange_timing_and_latency():
+    recorder = latency.LatencyRecorder()
+    comm = CollectingCommunication()
+    comm.latencies = recorder
+    comm.add_message(object(), "request", pipe.MessageTiming(100, 200, "www.example.com:80"))
+    comm.add_message(object(), "response", pipe.MessageTiming(1200, 1300, "www.example.com:80"))
+
+    assert comm.request_responses[-1].upstream_latency_ns() == 1000
+    assert recorder.summary("www.example.com:80")["p50"] == 1000
+
+
+def test_pipe_records_message_timing():
+    msg = b"HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\nabcd\r\n"
+    forwarded, comm = run_pipe_thread('response', [msg[:10], msg[10:]])
+
+    request_response, = comm.request_responses
+    assert request_response.upstream == "www.example.com:80"
+    assert request_response.response_first_byte_ns <= request_response.response_last_byte_ns
+
+
+@pytest.mark.parametrize("splice", [True, False], ids=["splice", "copy"])
+def test_pipe_moves_uncaptured_bodies_without_parsing(monkeypatch, splice):
+    monkeypatch.setattr(pipe, "SPLICE", pipe.SPLICE and splice)
+    body = bytes(range(256)) * 1000
+    msg = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body) + body
+    end = b"HTTP/1.1 404 Not Found\r\nContent-Length: 3\r\n\r\nabc"
+
+    forwarded, comm = run_pipe_thread('response', [msg[:100], msg[100:] + end], capture_body_limit=0,
+                                      recv_size=4096)
+
+    assert forwarded == msg + end
+    assert [rr.response.status for rr in comm.request_responses] == [b"200", b"404"]
+    assert comm.request_responses[0].response.body is None
+
+
+def test_flow_control_marks():
+    before = pipe.FlowControl.counts()
+    flow = pipe.FlowControl(high_water=100, low_water=10)
+
+    assert [flow.update(held) for held in (50, 101, 50, 9, 50)] == [False, True, True, False, False]
+    assert pipe.FlowControl.counts()["throttled_total"] - before["throttled_total"] == 1
+    flow.update(200)
+    assert pipe.FlowControl.counts()["throttled"] - before["throttled"] == 1
+    flow.close()
+    assert pipe.FlowControl.counts()["throttled"] == before["throttled"]
+
+
+def test_async_pipe_stops_reading_for_slow_sink():
+    body = b"x" * (8 * 1024 * 1024)
+    msg = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body) + body
+    received = []
+
+    def receive(sock):
+        data = sock.recv(65536)
+        while data:
+            received.append(data)
+            data = sock.recv(65536)
+
+    async def run():
+        source, source_peer = socket.socketpair()
+        sink, sink_peer = socket.socketpair()
+        reader, source_writer = await asyncio.open_connection(sock=source)
+        sink_reader, writer = await asyncio.open_connection(sock=sink)
+        with source_peer, sink_peer:
+            sender = threading.Thread(target=lambda: (source_peer.sendall(msg), source_peer.shutdown(socket.SHUT_WR)))
+            sender.start()
+
+            pipe_task = asyncio.ensure_future(async_pipe.AsyncPipe(
+                reader, writer, 'response', CollectingCommunication(), 'www.example.com', 80,
+                high_water=65536, low_water=16384).run())
+            # Nothing is read from the sink for a while
+            await asyncio.sleep(0.2)
+            throttled = pipe.FlowControl.counts()["throttled"]
+            held = writer.transport.get_write_buffer_size()
+
+            receiver = threading.Thread(target=receive, args=(sink_peer,))
+            receiver.start()
+            await pipe_task
+            writer.close()
+            source_writer.close()
+            await asyncio.get_running_loop().run_in_executor(None, receiver.join)
+            await asyncio.get_running_loop().run_in_executor(None, sender.join)
+        return throttled, held
+
+    before = pipe.FlowControl.counts()
+    throttled, held = asyncio.run(run())
+
+    assert throttled == before["throttled"] + 1
+    assert held <= 65536 + pipe.RECV_SIZE
+    assert pipe.FlowControl.counts()["throttled"] == before["throttled"]
+    assert b"".join(received) == msg
+
+
+def test_oversized_request_head_is_rejected():
+    client, client_peer = socket.socketpair()
+    upstream, upstream_peer = socket.socketpair()
+    with client, client_peer, upstream, upstream_peer:
+        thread = pipe.PipeThread(client, upstream, 'request', CollectingCommunication(), 'www.example.com', 80,
+                                 max_headers=1024)
+        thread.start()
+        client_peer.sendall(b"GET / HTTP/1.1\r\n" + b"X-Padding: xxxxxxxxxx\r\n" * 100)
+
+        answer = b""
+        data = client_peer.recv(1024)
+        while data:
+            answer += data
+            data = client_peer.recv(1024)
+        thread.join()
+        forwarded = upstream_peer.recv(1024)
+
+    assert answer == pipe.HEADERS_TOO_LARGE
+    assert forwarded == b""
+
+
+class Upstream:
+    """
+    A server answering every request on a connection with the same response, or with the same responses
+    sent one after the other when given a list
+    """
+
+    def __init__(self, response):
+        self.responses = response if isinstance(response, list) else [response]
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.server.settimeout(0.05)
+        self.port = self.server.getsockname()[1]
+        self.accepted = 0
+        self.stopped = False
+        self.threads = [threading.Thread(target=self.accept)]
+        self.threads[0].start()
+
+    def accept(self):
+        while not self.stopped:
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            self.accepted += 1
+            thread = threading.Thread(target=self.answer, args=(conn,))
+            self.threads.append(thread)
+            thread.start()
+
+    def answer(self, conn):
+        with conn:
+            conn.settimeout(5)
+            request = b""
+            while not self.stopped:
+                try:
+                    data = conn.recv(1024)
+                except (socket.timeout, OSError):
+                    return
+                if not data:
+                    return
+                request += data
+                while b"\r\n\r\n" in request:
+                    request = request.split(b"\r\n\r\n", 1)[1]
+                    for index, response in enumerate(self.responses):
+                        if index:
+                            # So that the responses arrive in separate reads
+                            time.sleep(0.05)
+                        conn.sendall(response)
+                    # Left open after Connection: close, so only the pipe's decision keeps it out of the pool
+                    if b"Content-Length" not in self.responses[-1]:
+                        return
+
+    def close(self):
+        self.stopped = True
+        for thread in self.threads:
+            thread.join()
+        self.server.close()
+
+
+def pooled_exchange(pool, port, method=b"GET", version=b"HTTP/1.1", connection=b"close", half_close=True,
+                    **options):
+    client, client_peer = socket.socketpair()
+    with client_peer:
+        client_peer.settimeout(5)
+        thread = pipe.PooledPipeThread(client, pool, CollectingCommunication(), '127.0.0.1', port, **options)
+        thread.start()
+        client_peer.sendall(b"%s / %s\r\nHost: localhost:8003\r\nConnection: %s\r\n\r\n" %
+                            (method, version, connection))
+        if half_close:
+            client_peer.shutdown(socket.SHUT_WR)
+        answer = b""
+        data = client_peer.recv(1024)
+        while data:
+            answer += data
+            data = client_peer.recv(1024)
+        thread.join()
+    return answer
+
+
+@pytest.mark.parametrize("response, reused", [
+    (b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok", True),
+    (b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok", False),
+    (b"HTTP/1.1 200 OK\r\n\r\nok", False),
+], ids=["keep-alive", "connection-close", "until-close"])
+def test_pooled_pipe_reuses_upstream_connections(response, reused):
+    upstream = Upstream(response)
+    pool = UpstreamPool()
+    try:
+        answers = [pooled_exchange(pool, upstream.port) for _ in range(2)]
+    finally:
+        for connection in pool.idle.pop(('127.0.0.1', upstream.port), ()):
+            connection.close()
+        upstream.close()
+
+    assert all(answer.endswith(b"ok") for answer in answers)
+    assert upstream.accepted == (1 if reused else 2)
+    assert pool.stats()["hits"] == (1 if reused else 0)
+    assert pool.stats()["evictions"] == 0
+
+
+@pytest.mark.parametrize("version, connection, response", [
+    (b"HTTP/1.1", b"keep-alive", b"HTTP/1.1 200 OK\r\n\r\nok"),
+    (b"HTTP/1.1", b"close", b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"),
+    (b"HTTP/1.0", b"x", b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"),
+    (b"HTTP/1.1", b"keep-alive", b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok"),
+], ids=["until-close", "client-close", "http-1.0", "upstream-close"])
+def test_pooled_pipe_closes_client_connection_after_last_exchange(version, connection, response):
+    upstream = Upstream(response)
+    pool = UpstreamPool()
+    try:
+        # The client waits for the connection to be closed without closing its side first
+        answer = pooled_exchange(pool, upstream.port, version=version, connection=connection, half_close=False)
+    finally:
+        for idle in pool.idle.pop(('127.0.0.1', upstream.port), ()):
+            idle.close()
+        upstream.close()
+
+    assert answer == response
+
+
+@pytest.mark.parametrize("method, responses", [
+    (b"GET", [b"HTTP/1.1 100 Continue\r\n\r\n", b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"]),
+    (b"HEAD", [b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n"]),
+], ids=["interim", "head"])
+def test_pooled_pipe_reads_whole_exchange(method, responses):
+    upstream = Upstream(responses)
+    pool = UpstreamPool()
+    try:
+        answers = [pooled_exchange(pool, upstream.port, method) for _ in range(2)]
+    finally:
+        for connection in pool.idle.pop(('127.0.0.1', upstream.port), ()):
+            connection.close()
+        upstream.close()
+
+    assert answers == [b"".join(responses)] * 2
+    assert upstream.accepted == 1
+    assert pool.stats()["hits"] == 1
+
+
+def test_pooled_pipe_closes_client_connection_for_oversized_response_head():
+    upstream = Upstream(b"HTTP/1.1 200 OK\r\n" + b"X-Padding: xxxxxxxxxx\r\n" * 100 + b"Content-Length: 2\r\n\r\nok")
+    pool = UpstreamPool()
+    try:
+        answer = pooled_exchange(pool, upstream.port, max_headers=1024)
+    finally:
+        upstream.close()
+
+    # Answering 431 would blame the client for the upstream's response
+    assert answer == b""
+    assert pool.stats()["idle"] == 0
+
+
+def test_pipelined_messages_are_timed_separately():
+    recorder = latency.LatencyRecorder()
+    comm = CollectingCommunication()
+    comm.latencies = recorder
+    requests = pipe.Pipe('request', comm, 'www.example.com', 80)
+    responses = pipe.Pipe('response', comm, 'www.example.com', 80)
+    requests.create_parser()
+    responses.create_parser()
+    msg = b"HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\nabcd\r\n"
+
+    requests.feed(b"GET /a HTTP/1.1\r\nHost: a\r\n\r\nGET /b HTTP/1.1\r\nHost: a\r\n\r\n")
+    responses.feed(msg[:10])
+    started = responses.received_ns
+    # The second message ends the batch, so the buffer is empty by the time it is forwarded
+    responses.feed(msg[10:] + msg)
+    pipelined = responses.received_ns
+
+    first, second = comm.request_responses[-2:]
+    assert first.response_first_byte_ns == started
+    assert second.response_first_byte_ns == pipelined
+    assert responses.first_byte_ns is None
+    assert recorder.summary("www.example.com:80")["count"] == 2
+
+
+def test_raw_pipe_rewrites_host_in_any_case():
+    msg = b"GET / HTTP/1.1\r\nAccept: */*\r\nhost: localhost:8003\r\nX-Host: b\r\n\r\n"
+
+    forwarded, comm = run_pipe_thread('request', [msg[:20], msg[20:] + msg], raw=True)
+
+    assert forwarded == b"GET / HTTP/1.1\r\nAccept: */*\r\nHost: www.example.com\r\nX-Host: b\r\n\r\n" * 2
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class PeakHeldPipeThread(pipe.PipeThread):
+    """Records the most bytes held after a feed"""
+    peak_held = 0
+
+    def feed(self, data):
+        super().feed(data)
+        self.peak_held = max(self.peak_held, self.held())
+
+
+@pytest.mark.parametrize("framing", ["length", "chunked", "until-close", "raw"])
+def test_pipe_thread_holds_bounded_bytes_for_slow_sink(framing):
+    body = b"x" * (8 * 1024 * 1024)
+    if framing == "chunked":
+        msg = b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n" + \
+              b"".join(b"10000\r\n%s\r\n" % piece for piece in chunks(body, 65536)) + b"0\r\n\r\n"
+    elif framing == "until-close":
+        msg = b"HTTP/1.1 200 OK\r\n\r\n" + body
+    else:
+        msg = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body) + body
+    source, source_peer = socket.socketpair()
+    sink, sink_peer = socket.socketpair()
+    with source, source_peer, sink, sink_peer:
+        thread = PeakHeldPipeThread(source, sink, 'response', CollectingCommunication(), 'www.example.com', 80,
+                                    high_water=65536, low_water=16384, max_body_in_memory=len(msg),
+                                    raw=framing == "raw")
+        thread.start()
+        sender = threading.Thread(target=lambda: (source_peer.sendall(msg), source_peer.shutdown(socket.SHUT_WR)))
+        sender.start()
+        # A sink not read from blocks the pipe, which stops reading the source
+        sender.join(0.2)
+        paused = sender.is_alive()
+
+        forwarded = []
+        data = sink_peer.recv(65536)
+        while data:
+            forwarded.append(data)
+            data = sink_peer.recv(65536)
+        sender.join()
+        thread.join()
+
+    forwarded = b"".join(forwarded)
+    if framing == "chunked":
+        # Chunks are forwarded as they arrive, not as they were sent
+        response, = pipe.parse(pipe.intialize_parser(pipe.http_parser.get_http_request), forwarded)
+        assert response.body == body
+    else:
+        assert forwarded == msg
+    assert thread.peak_held <= 65536 + pipe.RECV_SIZE
+    assert paused
+
+
+def test_oversized_request_head_is_answered_by_the_response_pipe():
+    client, client_peer = socket.socketpair()
+    upstream, upstream_peer = socket.socketpair()
+    with client, client_peer, upstream, upstream_peer:
+        comm = CollectingCommunication()
+        request = pipe.PipeThread(client, upstream, 'request', comm, 'www.example.com', 80, max_headers=1024)
+        request.response_pipe = pipe.PipeThread(upstream, client, 'response', comm, 'www.example.com', 80)
+        request.response_pipe.start()
+        request.start()
+        response = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+        upstream_peer.sendall(response)
+        answer = b""
+        while len(answer) < len(response):
+            answer += client_peer.recv(1024)
+        client_peer.sendall(b"GET / HTTP/1.1\r\n" + b"X-Padding: xxxxxxxxxx\r\n" * 100)
+
+        data = client_peer.recv(1024)
+        while data:
+            answer += data
+            data = client_peer.recv(1024)
+        request.join()
+        request.response_pipe.join()
+        forwarded = upstream_peer.recv(1024)
+
+    assert answer == response + pipe.HEADERS_TOO_LARGE
+    assert forwarded == b""
+
+
+def test_async_pipe_rejects_oversized_request_head():
+    async def run():
+        client, client_peer = socket.socketpair()
+        upstream, upstream_peer = socket.socketpair()
+        client_reader, client_writer = await asyncio.open_connection(sock=client)
+        upstream_reader, upstream_writer = await asyncio.open_connection(sock=upstream)
+        comm = CollectingCommunication()
+        request = async_pipe.AsyncPipe(client_reader, upstream_writer, 'request', comm, 'www.example.com', 80,
+                                       max_headers=1024)
+        request.response_pipe = async_pipe.AsyncPipe(upstream_reader, client_writer, 'response', comm,
+                                                     'www.example.com', 80)
+
+        client_peer.sendall(b"GET / HTTP/1.1\r\n" + b"X-Padding: xxxxxxxxxx\r\n" * 100)
+        await asyncio.gather(request.run(), request.response_pipe.run())
+        client_writer.close()
+        upstream_writer.close()
+
+        with client_peer, upstream_peer:
+            answer = b""
+            data = client_peer.recv(1024)
+            while data:
+                answer += data
+                data = client_peer.recv(1024)
+            return answer, upstream_peer.recv(1024)
+
+    answer, forwarded = asyncio.run(run())
+
+    assert answer == pipe.HEADERS_TOO_LARGE
+    assert forwarded == b""
+
+
+def test_async_pinhole_forwards_with_backlog_option():
+    response = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+    upstream = Upstream(response)
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    pinhole = async_pipe.AsyncPinhole(port, '127.0.0.1', upstream.port, CollectingCommunication, backlog=5)
+
+    async def run():
+        server = asyncio.create_task(pinhole.serve())
+        try:
+            for _ in range(100):
+                try:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                    break
+                except OSError:
+                    await asyncio.sleep(0.01)
+            writer.write(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            writer.write_eof()
+            answer = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return answer
+        finally:
+            server.cancel()
+
+    try:
+        answer = asyncio.run(run())
+    finally:
+        upstream.close()
+
+    assert answer == response
+
+
+def test_preview_of_body_cut_by_capture_limit_is_truncated():
+    text = b"".join(b"line %d of a text body\n" % i for i in range(100))
+    body = zlib.compress(text, 0)
+    msg = b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Encoding: deflate\r\n" + \
+          b"Transfer-Encoding: chunked\r\n\r\n" + \
+          b"".join(b"%x\r\n%s\r\n" % (len(piece), piece) for piece in chunks(body, 64)) + b"0\r\n\r\n"
+
+    forwarded, comm = run_pipe_thread('response', chunks(msg, 5), capture_body_limit=40)
+
+    response = comm.request_responses[0].response
+    assert response.body == body[:40]
+    assert response.preview() == (text[:33], True, True)
+    assert response.format().endswith(str(text[:33]) + "... (truncated)\n")
@@ -0,0 +1,83 @@
+import http.server
+import socket
+import threading
+import time
+import urllib.request
+
+import capture
+import supervisor
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+class CollectingSink(capture.CaptureSink):
+    def __init__(self):
+        self.written = []
+        super().__init__()
+
+    def write(self, request_response):
+        self.written.append(request_response)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def get(port, path):
+    for _ in range(100):
+        try:
+            with urllib.request.urlopen("http://127.0.0.1:%d%s" % (port, path), timeout=5) as response:
+                return response.read()
+        except (ConnectionError, urllib.error.URLError):
+            time.sleep(0.05)
+    raise AssertionError("no worker answered")
+
+
+def test_workers_share_the_port_and_are_restarted():
+    upstream = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    port = free_port()
+    sink = CollectingSink()
+    workers = supervisor.Supervisor(2, port, "127.0.0.1", upstream.server_address[1], sink=sink,
+                                    report_interval=0.1, instrumented=True)
+    workers.start()
+    try:
+        assert [get(port, "/%d" % i) for i in range(4)] == [b"ok"] * 4
+        def complete():
+            return [rr for rr in sink.written if rr.request is not None and rr.response is not None]
+
+        wait_for(lambda: len(complete()) == 4)
+        assert sorted(rr.request.path for rr in complete()) == [b"/0", b"/1", b"/2", b"/3"]
+        wait_for(lambda: workers.metrics()["parser_stats"].get("messages") == 8)
+        assert workers.metrics()["latency"]["127.0.0.1:%d" % upstream.server_address[1]]["count"] == 4
+
+        workers.processes[0].kill()
+        workers.processes[0].join()
+        workers.check_workers()
+        assert workers.restarts == 1
+        assert get(port, "/again") == b"ok"
+        assert workers.metrics()["workers"] == 2
+    finally:
+        workers.stop()
+        sink.close()
+        upstream.shutdown()
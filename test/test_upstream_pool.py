@@ -0,0 +1,82 @@
+import socket
+import threading
+import time
+
+from upstream_pool import UpstreamPool
+
+
+def listen():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    return server, server.getsockname()[1]
+
+
+def test_released_connection_is_reused():
+    server, port = listen()
+    pool = UpstreamPool(max_size=1)
+
+    first = pool.acquire('127.0.0.1', port)
+    pool.release(first)
+    second = pool.acquire('127.0.0.1', port)
+
+    assert second is first
+    assert pool.stats() == {'hits': 1, 'misses': 1, 'evictions': 0, 'idle': 0}
+    second.close()
+    server.close()
+
+
+def test_pool_is_bounded():
+    server, port = listen()
+    pool = UpstreamPool(max_size=1)
+
+    first = pool.acquire('127.0.0.1', port)
+    second = pool.acquire('127.0.0.1', port)
+    pool.release(first)
+    pool.release(second)
+
+    assert pool.stats()['idle'] == 1
+    assert second.sock.fileno() == -1
+    pool.acquire('127.0.0.1', port).close()
+    server.close()
+
+
+def test_closed_and_expired_connections_are_evicted():
+    server, port = listen()
+    pool = UpstreamPool(idle_timeout=60)
+
+    connection = pool.acquire('127.0.0.1', port)
+    accepted, _ = server.accept()
+    pool.release(connection)
+    accepted.close()
+    replacement = pool.acquire('127.0.0.1', port)
+    assert replacement is not connection
+
+    expired = replacement
+    pool.release(expired)
+    expired.last_used -= 120
+    replacement = pool.acquire('127.0.0.1', port)
+    assert replacement is not expired
+
+    assert pool.stats()['evictions'] == 2
+    replacement.close()
+    server.close()
+
+
+def test_idle_connections_are_evicted_in_the_background():
+    server, port = listen()
+    pool = UpstreamPool(idle_timeout=0.05)
+    pool.release(pool.acquire('127.0.0.1', port))
+    stopped = threading.Event()
+    thread = threading.Thread(target=pool.evict_idle_until, args=(stopped,))
+    thread.start()
+    try:
+        deadline = time.monotonic() + 5
+        while pool.stats()['idle'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        stopped.set()
+        thread.join()
+        server.close()
+
+    assert pool.stats() == {'hits': 0, 'misses': 1, 'evictions': 1, 'idle': 0}
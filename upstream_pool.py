@@ -0,0 +1,97 @@
+"""
+Keep-alive connections to upstream servers, shared between client connections.
+"""
+
+import collections
+import select
+import time
+from socket import *
+from threading import Lock
+
+
+class PooledConnection:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.sock = socket(AF_INET, SOCK_STREAM)
+        self.sock.connect((host, port))
+        self.last_used = time.monotonic()
+
+    def is_healthy(self):
+        # An idle connection must not be readable: that means the server closed it or sent something unasked
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class UpstreamPool:
+    """
+    Bounded per-upstream pools of idle keep-alive connections.
+
+    Connections idle for longer than idle_timeout, or found closed or readable when checked out, are evicted.
+    """
+
+    def __init__(self, max_size=8, idle_timeout=30.0):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = collections.defaultdict(collections.deque)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, host, port):
+        now = time.monotonic()
+        with self.lock:
+            idle = self.idle[(host, port)]
+            while idle:
+                # Most recently used first, the others are more likely to time out
+                connection = idle.pop()
+                if now - connection.last_used <= self.idle_timeout and connection.is_healthy():
+                    self.hits += 1
+                    return connection
+                self.evictions += 1
+                connection.close()
+            self.misses += 1
+
+        return PooledConnection(host, port)
+
+    def release(self, connection, reusable=True):
+        with self.lock:
+            idle = self.idle[(connection.host, connection.port)]
+            if reusable and len(idle) < self.max_size:
+                connection.last_used = time.monotonic()
+                idle.append(connection)
+                return
+        connection.close()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            for idle in self.idle.values():
+                for connection in [c for c in idle if now - c.last_used > self.idle_timeout]:
+                    idle.remove(connection)
+                    connection.close()
+                    self.evictions += 1
+
+    def evict_idle_until(self, stopped):
+        """Evict the connections timed out every idle_timeout / 2 seconds, until the stopped event is set"""
+        while not stopped.wait(self.idle_timeout / 2):
+            self.evict_idle()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'idle': sum(len(idle) for idle in self.idle.values()),
+            }